@@ -7,41 +7,581 @@ http://www.meteoprog.ua, pogoda.by и rp5.ua
 from __future__ import unicode_literals
 
 import urllib2
+import urlparse
+import httplib
+import socket
+import threading
 import datetime
 import csv
-import pylab
 import os
 import sys
 import zipfile
 import math
-from bs4 import BeautifulSoup
+import array
+import json
+import mmap
+import struct
+import zlib
+import gzip
+import re
+import hashlib
+import time
+import BaseHTTPServer
+import SocketServer
+from HTMLParser import HTMLParser
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.dammit import EntitySubstitution
 import calendar
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 #from BeautifulSoup import BeautifulSoup
 
 if sys.platform == "win32":
     sys.path.append(os.path.abspath("."))
 
-#set line width
-pylab.rcParams['lines.linewidth'] = 6
-#set font size for titles
-pylab.rcParams['axes.titlesize'] = 20
-#set font size for labels on axes
-pylab.rcParams['axes.labelsize'] = 20
-#set size of numbers on x-axis
-pylab.rcParams['xtick.major.size'] = 5
-#set size of numbers on y-axis
-pylab.rcParams['ytick.major.size'] = 5
+# настройки графиков, применяются при первом построении (load_pylab)
+PLOT_RC = {
+    #set line width
+    'lines.linewidth': 6,
+    #set font size for titles
+    'axes.titlesize': 20,
+    #set font size for labels on axes
+    'axes.labelsize': 20,
+    #set size of numbers on x-axis
+    'xtick.major.size': 5,
+    #set size of numbers on y-axis
+    'ytick.major.size': 5,
+    #'text.usetex': True,
+    #'text.latex.unicode': True,
+    'text.usetex': False,
+    'font.sans-serif': ['Liberation Sans'],
+    'font.serif': ['Liberation Serif'],
+}
 
-#pylab.rcParams['text.usetex']=True
-#pylab.rcParams['text.latex.unicode']=True
+# pylab (matplotlib и numpy) импортируется только для построения графиков
+pylab = None
 
-pylab.rcParams['text.usetex']=False
-pylab.rcParams['font.sans-serif'] = ['Liberation Sans']
-pylab.rcParams['font.serif'] = ['Liberation Serif'] 
+def apply_plot_rc():
+    """
+    Применяет PLOT_RC к настройкам matplotlib
+    """
+    import matplotlib
+    matplotlib.rcParams.update(PLOT_RC)
+
+def load_pylab():
+    """
+    Импортирует pylab при первом вызове и применяет к нему PLOT_RC
+    """
+    global pylab
+    if pylab is None:
+        import pylab as module
+        module.rcParams.update(PLOT_RC)
+        pylab = module
+    return pylab
 
 class NotPage:
     pass
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_stamp(date):
+    """
+    Преобразует datetime.datetime в число секунд от начала эпохи (UTC)
+    """
+    return calendar.timegm(date.timetuple())
+
+def from_stamp(stamp):
+    """
+    Преобразует число секунд от начала эпохи в datetime.datetime
+    """
+    return EPOCH + datetime.timedelta(seconds=stamp)
+
+def months(start, end):
+    """
+    Возвращает список первых чисел месяцев с start по end включительно
+    """
+    dates = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        dates.append(datetime.datetime(year, month, 1))
+        year, month = (year+1, 1) if month == 12 else (year, month+1)
+    return dates
+
+def is_month_closed(date, moment):
+    """
+    Закончился ли к моменту moment (UTC, секунды) месяц date
+    """
+    year, month = (date.year+1, 1) if date.month == 12 else (date.year, date.month+1)
+    # архивы обновляются с задержкой, поэтому ждем еще сутки
+    return moment >= to_stamp(datetime.datetime(year, month, 1)) + 24*3600
+
+def to_float(value):
+    """
+    Преобразует значение в float, пропуски и ошибки - в NaN
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+SNAPSHOT_MAGIC = b"METEOSNP"
+
+# начало строки файла, сохраненного save(): дата, час, минуты
+SAVED_ROW = re.compile(br"(?:^|\n)(\d{4})-(\d{2})-(\d{2}),(\d+),(\d+),")
+
+def last_saved_stamp(fname, compress=False):
+    """
+    Возвращает время последней строки файла, сохраненного save(), или None.
+    Просматривается только конец файла (сжатый файл распаковывается потоком)
+    """
+    tail_size = 64*1024
+    tail = b""
+    with (gzip.open(fname, "rb") if compress else open(fname, "rb")) as f:
+        if not compress:
+            f.seek(max(0, os.path.getsize(fname)-tail_size))
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            tail = (tail+chunk)[-tail_size:]
+    rows = SAVED_ROW.findall(tail)
+    if not rows:
+        return None
+    return to_stamp(datetime.datetime(*map(int, rows[-1])))
+
+def read_snapshot_header(data):
+    """
+    Возвращает заголовок снимка (см. MeteoStation.save_snapshot) из начала
+    data и смещение начала данных столбцов
+    """
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a MeteoData snapshot")
+    pos = len(SNAPSHOT_MAGIC)
+    length, = struct.unpack(b"<I", data[pos:pos+4])
+    pos += 4
+    header = json.loads(data[pos:pos+length].decode("utf-8"))
+    if header["version"] != 1:
+        raise ValueError("Unsupported snapshot version %s" % header["version"])
+    return header, pos+length
+
+def snapshot_info(fname):
+    """
+    Возвращает заголовок снимка fname, не читая данные
+    """
+    with open(fname, "rb") as f:
+        start = f.read(len(SNAPSHOT_MAGIC)+4)
+        length, = struct.unpack(b"<I", start[-4:])
+        return read_snapshot_header(start+f.read(length))[0]
+
+class FloatColumn(object):
+    """
+    Столбец вещественных значений (float64).
+    Значения, которые не удалось преобразовать в float, хранятся как NaN
+    """
+    def __init__(self, values=()):
+        self.data = array.array('d')
+        self.extend(values)
+
+    @classmethod
+    def from_array(cls, data):
+        """
+        Столбец поверх готового массива array('d')
+        """
+        column = cls()
+        column.data = data
+        return column
+
+    def append(self, value):
+        self.data.append(to_float(value))
+
+    def extend(self, values):
+        if isinstance(values, FloatColumn):
+            self.data.extend(values.data)
+        else:
+            self.data.extend(to_float(value) for value in values)
+
+    def tolist(self):
+        return self.data.tolist()
+
+    def take(self, rows):
+        """
+        Новый столбец из строк rows
+        """
+        data = self.data
+        return FloatColumn.from_array(array.array('d', (data[idx] for idx in rows)))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.data[idx].tolist()
+        return self.data[idx]
+
+    def __setitem__(self, idx, value):
+        self.data[idx] = to_float(value)
+
+    def __delitem__(self, idx):
+        del self.data[idx]
+
+class CodeColumn(object):
+    """
+    Категориальный столбец: значения хранятся как коды в массиве int,
+    сами значения - один раз в списке categories
+    """
+    def __init__(self, values=()):
+        self.codes = array.array('i')
+        self.categories = []
+        self.lookup = {}
+        self.extend(values)
+
+    @classmethod
+    def from_codes(cls, codes, categories):
+        """
+        Столбец из готовых массива кодов array('i') и списка категорий
+        """
+        column = cls()
+        column.codes = codes
+        column.categories = list(categories)
+        column.lookup = dict((value, code) for code, value in enumerate(column.categories))
+        return column
+
+    def code(self, value):
+        """
+        Возвращает код значения value, добавляя новую категорию при необходимости
+        """
+        try:
+            return self.lookup[value]
+        except KeyError:
+            code = self.lookup[value] = len(self.categories)
+            self.categories.append(value)
+            return code
+
+    def append(self, value):
+        self.codes.append(self.code(value))
+
+    def extend(self, values):
+        self.codes.extend(self.code(value) for value in values)
+
+    def tolist(self):
+        categories = self.categories
+        return [categories[code] for code in self.codes]
+
+    def take(self, rows):
+        """
+        Новый столбец из строк rows
+        """
+        codes = self.codes
+        return CodeColumn.from_codes(array.array('i', (codes[idx] for idx in rows)), self.categories)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        categories = self.categories
+        return (categories[code] for code in self.codes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            categories = self.categories
+            return [categories[code] for code in self.codes[idx]]
+        return self.categories[self.codes[idx]]
+
+class TableRowParser(HTMLParser):
+    """
+    Потоковое извлечение строк таблицы без построения дерева bs4.
+    Обрабатывает те же события HTMLParser, что и BeautifulSoupHTMLParser
+    (bs4/builder/_htmlparser.py), но вместо узлов дерева накапливает только
+    текст ячеек <td>: при закрытии </tr> строка (список текстов ячеек)
+    добавляется в self.rows. Учитываются только таблицы с классом table_class
+    """
+    def __init__(self, table_class="archive_table"):
+        HTMLParser.__init__(self)
+        self.table_class = table_class
+        # найдена ли таблица
+        self.found = False
+        # уровень вложенности таблиц внутри нужной, 0 - вне таблицы
+        self.depth = 0
+        self.row = None
+        self.cell = None
+        self.rows = []
+
+    def end_cell(self):
+        if self.cell is not None:
+            self.row.append("".join(self.cell))
+            self.cell = None
+
+    def end_row(self):
+        self.end_cell()
+        if self.row is not None:
+            self.rows.append(self.row)
+            self.row = None
+
+    def handle_starttag(self, name, attrs):
+        if name == "table":
+            if self.depth:
+                self.depth += 1
+            else:
+                for key, value in attrs:
+                    if key == "class" and value and self.table_class in value.split():
+                        self.depth = 1
+                        self.found = True
+        elif self.depth != 1:
+            return
+        elif name == "tr":
+            # </tr> и </td> в HTML можно не закрывать
+            self.end_row()
+            self.row = []
+        elif name == "td" and self.row is not None:
+            self.end_cell()
+            self.cell = []
+
+    def handle_endtag(self, name):
+        if not self.depth:
+            return
+        if name == "table":
+            if self.depth == 1:
+                self.end_row()
+            self.depth -= 1
+        elif self.depth != 1:
+            return
+        elif name == "td":
+            self.end_cell()
+        elif name == "tr":
+            self.end_row()
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+    def handle_charref(self, name):
+        if name.startswith('x') or name.startswith('X'):
+            real_name = int(name[1:], 16)
+        else:
+            real_name = int(name)
+        try:
+            data = unichr(real_name)
+        except (ValueError, OverflowError):
+            data = "\N{REPLACEMENT CHARACTER}"
+        self.handle_data(data)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        if character is not None:
+            data = character
+        else:
+            data = "&%s;" % name
+        self.handle_data(data)
+
+def iter_table_rows(html, table_class="archive_table", chunk_size=64*1024):
+    """
+    Возвращает строки таблицы с классом table_class из страницы html
+    по мере разбора, страница подается в парсер кусками по chunk_size
+    """
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", "replace")
+    parser = TableRowParser(table_class)
+    for pos in range(0, len(html), chunk_size):
+        parser.feed(html[pos:pos+chunk_size])
+        for row in parser.rows:
+            yield row
+        del parser.rows[:]
+    parser.close()
+    parser.end_row()
+    for row in parser.rows:
+        yield row
+    if not parser.found:
+        raise NotPage
+
+def write_file(fname, data):
+    """
+    Атомарная запись data в файл fname через временный файл
+    """
+    tmp = fname+".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    replace_file(tmp, fname)
+
+def replace_file(src, dst):
+    """
+    Переименовывает src в dst, заменяя dst если он существует
+    """
+    if sys.platform == "win32" and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+def is_complete_zip(fname):
+    """
+    Проверяет, что fname - целый zip архив (CRC всех файлов совпадает)
+    """
+    try:
+        zfile = zipfile.ZipFile(fname, "r")
+    except (IOError, zipfile.BadZipfile):
+        return False
+    try:
+        return zfile.testzip() is None
+    except Exception:
+        return False
+    finally:
+        zfile.close()
+
+class ZipDownloader(object):
+    """
+    Параллельная загрузка архивов pogoda.by.
+    Каждый поток держит свое постоянное соединение с сервером, архив
+    пишется потоком во временный файл <имя>.part и переименовывается
+    только после проверки целостности. Целые архивы повторно не загружаются
+    """
+    def __init__(self, base_url="http://pogoda.by/zip/", city_code="34504", workers=4):
+        url = urlparse.urlsplit(base_url)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.path = url.path
+        self.city_code = city_code
+        self.workers = workers
+        self.local = threading.local()
+
+    def url_path(self, year, month):
+        """
+        http://pogoda.by/zip/2011/34504_2011-01.zip
+        """
+        return self.path+"%04d/%s_%04d-%02d.zip" % (year, self.city_code, year, month)
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if self.scheme == "https":
+                conn = httplib.HTTPSConnection(self.host, timeout=60)
+            else:
+                conn = httplib.HTTPConnection(self.host, timeout=60)
+            self.local.conn = conn
+        return conn
+
+    def request(self, path):
+        # сервер мог закрыть постоянное соединение - переподключаемся один раз
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request("GET", path)
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+    def fetch(self, year, month, fname):
+        """
+        Загружает архив за месяц в файл fname
+        """
+        path = self.url_path(year, month)
+        print "Download "+path
+        response = self.request(path)
+        if response.status != 200:
+            response.read()
+            raise IOError("HTTP %d: %s" % (response.status, path))
+        tmp = fname+".part"
+        with open(tmp, "wb") as f:
+            while True:
+                chunk = response.read(64*1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+        if not is_complete_zip(tmp):
+            os.remove(tmp)
+            raise IOError("Broken zip: %s" % path)
+        replace_file(tmp, fname)
+        return fname
+
+    def download(self, jobs):
+        """
+        Загружает архивы jobs - список (год, месяц, имя файла),
+        пропуская уже загруженные целые архивы.
+        Возвращает список загруженных файлов
+        """
+        jobs = [job for job in jobs if not is_complete_zip(job[2])]
+        if not jobs:
+            return []
+        pool = ThreadPool(min(self.workers, len(jobs)))
+        try:
+            return pool.map(lambda job: self.fetch(*job), jobs)
+        finally:
+            pool.terminate()
+
+class ResponseCache(object):
+    """
+    Кэш страниц архива на диске.
+    Страница за месяц хранится в файле <directory>/<city>/<YYYY>_<MM>.html,
+    рядом в .json - адрес, заголовки ETag и Last-Modified и время загрузки.
+    Страница, загруженная после окончания месяца, не устаревает никогда,
+    страница текущего месяца устаревает через ttl секунд и затем
+    перепроверяется условным запросом
+    """
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+
+    def paths(self, city, date):
+        base = os.path.join(self.directory, city, date.strftime("%Y_%m"))
+        return base+".html", base+".json"
+
+    def fetch(self, url, city, date):
+        """
+        Возвращает страницу по адресу url для города city за месяц date,
+        загружая ее только если в кэше ее нет или она устарела
+        """
+        body_path, meta_path = self.paths(city, date)
+        meta = None
+        if os.path.isfile(body_path) and os.path.isfile(meta_path):
+            with open(meta_path, "rb") as f:
+                meta = json.load(f)
+            if meta["closed"] or time.time() - meta["fetched"] < self.ttl:
+                with open(body_path, "rb") as f:
+                    return f.read()
+        request = urllib2.Request(url)
+        if meta is not None:
+            if meta.get("etag"):
+                request.add_header("If-None-Match", meta["etag"])
+            if meta.get("last-modified"):
+                request.add_header("If-Modified-Since", meta["last-modified"])
+        try:
+            response = urllib2.urlopen(request)
+            body = response.read()
+            headers = response.info()
+        except urllib2.HTTPError as e:
+            if e.code != 304 or meta is None:
+                raise
+            # страница не изменилась
+            with open(body_path, "rb") as f:
+                body = f.read()
+            headers = e.info()
+        now = time.time()
+        meta = {"url": url,
+                "etag": headers.getheader("ETag") or (meta or {}).get("etag"),
+                "last-modified": headers.getheader("Last-Modified") or (meta or {}).get("last-modified"),
+                "fetched": now,
+                "closed": is_month_closed(date, now)}
+        if not os.path.isdir(os.path.dirname(body_path)):
+            try:
+                os.makedirs(os.path.dirname(body_path))
+            except OSError: # создан другим потоком
+                pass
+        write_file(body_path, body)
+        write_file(meta_path, json.dumps(meta))
+        return body
+
+def default_cache():
+    """
+    Кэш страниц meteoprog.ua в папке meteoprog.ua/cache рядом с модулем
+    """
+    enc = sys.getfilesystemencoding()
+    curplace = os.path.dirname(__file__).decode(enc)
+    return ResponseCache(os.path.join(curplace, "meteoprog.ua", "cache"))
+
 class MeteoStation(object):
     """
     Получение метеоданных. Базовый класс
@@ -63,10 +603,26 @@ class MeteoStation(object):
                        "local presure", # местное давление
                        "local speed"	# местная скорость
                        ]      
+        # высота станции над уровнем моря, м (г. Днепропетровск)
+        self.height = 155.
+        # высота, к которой приводится скорость ветра, м
+        self.speed_height = 0.01
+        # множитель перевода давления из таблицы в мм. рт. ст.
+        self.press_scale = 1.
+        # категориальные столбцы, остальные - вещественные
+        self.categorical = ["date", "hour", "min", "direct wind"]
+        # формат вещественных полей при сохранении в csv (по умолчанию %.12g)
+        self.formats = {"precipitation": "%g",
+                        "speed wind":    "%g",
+                        "temperature":   "%g",
+                        "humidity":      "%g",
+                        "presure":       "%g"}
         # данные
         self.table = {}
         for key in self.tbody:
-            self.table[key] = []
+            self.table[key] = self.new_column(key)
+        # индекс время -> номер строки (см. update_index)
+        self.drop_index()
     
     def local_press(self, sea_press, t, h=155.):
         """
@@ -85,48 +641,366 @@ class MeteoStation(object):
         Приведение скорости ветра к высоте hl
         """        
         return speed*(hl/h)**(1./5.)
+
+    def local_press_column(self, sea_press, temps, h=155.):
+        """
+        Приведение к местным условиям столбца атмосферного давления
+        sea_press при столбце температур temps (см. local_press)
+        """
+        M = 0.029
+        g = 9.81
+        R = 8.314
+        k = -M*g*h/R
+        exp = math.exp
+        return [p*exp(k/(273.15+t)) for p, t in zip(sea_press, temps)]
+
+    def local_speed_column(self, speeds, h=10., hl=0.01):
+        """
+        Приведение столбца скоростей ветра к высоте hl (см. local_speed)
+        """
+        factor = (hl/h)**(1./5.)
+        return [speed*factor for speed in speeds]
+
+    def compute_local(self, h=None, hl=None, start=0):
+        """
+        Пересчитывает столбцы "local presure" и "local speed" по столбцам
+        "presure", "temperature" и "speed wind" начиная со строки start.
+            h  - высота станции над уровнем моря, м (по умолчанию self.height)
+            hl - высота, к которой приводится скорость ветра, м
+                 (по умолчанию self.speed_height)
+        """
+        if h is None:
+            h = self.height
+        if hl is None:
+            hl = self.speed_height
+        press = self.table["presure"][start:]
+        if self.press_scale != 1.:
+            press = [p*self.press_scale for p in press]
+        lpress = self.local_press_column(press, self.table["temperature"][start:], h)
+        lspeed = self.local_speed_column(self.table["speed wind"][start:], hl=hl)
+        for field, values in (("local presure", lpress), ("local speed", lspeed)):
+            del self.table[field][start:]
+            self.table[field].extend(values)
     
+    def new_column(self, field, values=()):
+        """
+        Создает пустой столбец для поля field подходящего типа
+        """
+        if field in self.categorical:
+            return CodeColumn(values)
+        return FloatColumn(values)
+
     def parse(self, date):
         raise NotImplemented
 
-    def save(self, fname):
-        n = len(self.table[self.tbody[0]])
-        with open(fname, "wb") as csvfile:
+    def fetch_month(self, date):
+        """
+        Возвращает исходные данные за месяц date (страницу, архив, блок файла).
+        По ним sync определяет, изменились ли данные месяца
+        """
+        raise NotImplementedError
+
+    def parse_month(self, date, data):
+        """
+        Разбор данных data за месяц date, полученных fetch_month
+        """
+        self.parse(date)
+
+    def keep_rows(self, rows):
+        """
+        Оставляет в таблице только строки rows в указанном порядке
+        """
+        self.update_index()
+        stamps = self._stamps
+        for field in self.tbody:
+            self.table[field] = self.table[field].take(rows)
+        self.drop_index()
+        self._indexed_dates = self.table["date"]
+        self._stamps = array.array('l', (stamps[idx] for idx in rows))
+        self.index_stamps(0)
+
+    def drop_index(self):
+        """
+        Сбрасывает индексы время -> номер строки и день -> интервалы строк
+        """
+        self._index = {}
+        self._days = {}
+        self._stamps = array.array('l')
+        self._indexed_dates = None
+
+    def update_index(self):
+        """
+        Дополняет индексы время -> номер строки и день -> интервалы строк
+        строками, которые были добавлены в self.table после последнего
+        обновления.
+        Если таблица была заменена или укорочена, индекс строится заново
+        """
+        dates = self.table["date"]
+        if dates is not self._indexed_dates or len(dates) < len(self._stamps):
+            self.drop_index()
+            self._indexed_dates = dates
+        start = len(self._stamps)
+        if start < len(dates):
+            stamps = self.convert_date(dates[start:],
+                                       self.table["hour"][start:],
+                                       self.table["min"][start:])
+            self._stamps.extend(to_stamp(date) for date in stamps)
+            self.index_stamps(start)
+        return self._index
+
+    def index_stamps(self, start):
+        """
+        Добавляет в индексы строки начиная со start по уже известным
+        временам self._stamps
+        """
+        last_day = None
+        for idx in xrange(start, len(self._stamps)):
+            stamp = self._stamps[idx]
+            # как и list.index - первое вхождение
+            self._index.setdefault(stamp, idx)
+            day_stamp = stamp - stamp % 86400
+            if day_stamp != last_day:
+                last_day = day_stamp
+                rows = self._days.setdefault(from_stamp(day_stamp), [])
+            if rows and rows[-1][1] == idx:
+                rows[-1][1] = idx+1
+            else:
+                rows.append([idx, idx+1])
+
+    def save(self, fname, compress=None, append=False, block_size=10000):
+        """
+        Сохраняет таблицу в файл csv, возвращает число записанных строк.
+            compress   - сжимать gzip, по умолчанию - если имя оканчивается на .gz
+            append     - дописать в существующий файл только строки, которые
+                         позже последней строки файла
+            block_size - число строк, записываемых за один вызов writerows
+        Строки записываются в порядке времени (в таблице rp5 они идут от
+        новых к старым), поэтому последняя строка файла - самая поздняя.
+        Каждый столбец преобразуется в текст один раз
+        (вещественные поля - по формату из self.formats)
+        """
+        if compress is None:
+            compress = fname.endswith(".gz")
+        self.update_index()
+        stamps = self._stamps
+        rows = None # все строки в порядке таблицы
+        if any(a > b for a, b in itertools.izip(stamps, itertools.islice(stamps, 1, None))):
+            rows = sorted(xrange(len(stamps)), key=stamps.__getitem__)
+        if append and os.path.isfile(fname) and os.path.getsize(fname):
+            last = last_saved_stamp(fname, compress)
+            if last is not None:
+                if rows is None:
+                    rows = xrange(len(stamps))
+                rows = [idx for idx in rows if stamps[idx] > last]
+        else:
+            append = False
+        texts = [self.column_text(field, rows) for field in self.tbody]
+        n = len(texts[0])
+        mode = "ab" if append else "wb"
+        with (gzip.open(fname, mode) if compress else open(fname, mode, 1 << 20)) as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow(self.tbody)
-            for i in range(n):
-                row = []
+            if not append:
+                writer.writerow([field.encode("utf-8") for field in self.tbody])
+            for pos in xrange(0, n, block_size):
+                writer.writerows(zip(*[text[pos:pos+block_size] for text in texts]))
+        return n
+
+    def column_text(self, field, rows=None):
+        """
+        Возвращает список текстовых значений (utf-8) поля field для строк
+        rows (по умолчанию всех)
+        """
+        column = self.table[field]
+        if isinstance(column, CodeColumn):
+            texts = []
+            for value in column.categories:
+                if value is None:
+                    value = ""
+                elif isinstance(value, unicode):
+                    value = value.encode("utf-8")
+                texts.append(str(value))
+            codes = column.codes if rows is None else [column.codes[idx] for idx in rows]
+            return [texts[code] for code in codes]
+        fmt = self.formats.get(field, "%.12g")
+        values = column.data if rows is None else [column.data[idx] for idx in rows]
+        # NaN != NaN - пропуски записываются пустыми
+        return [fmt % value if value == value else "" for value in values]
+
+    def parse_file(self, fname, start=None, end=None, fields=None, chunk_size=10000):
+        """
+        Загружает строки из файла csv в формате save() (.gz - сжатого gzip)
+        и добавляет их в self.table.
+            start, end - загружать только дни с start по end включительно
+            fields     - загружать только эти поля (дата и время загружаются
+                         всегда), остальные заполняются пропусками
+        Файл читается кусками по chunk_size строк, каждый кусок
+        добавляется в столбцы целиком.
+        Текущим месяцем self.date становится последний загруженный месяц
+        """
+        first_row = len(self.table["date"])
+        with (gzip.open(fname, "rb") if fname.endswith(".gz") else open(fname, "rb")) as csvfile:
+            reader = csv.reader(csvfile)
+            header = [field.decode("utf-8") for field in next(reader)]
+            wanted = set(self.tbody if fields is None else fields)
+            wanted.update(("date", "hour", "min"))
+            columns = [(pos, field) for pos, field in enumerate(header)
+                       if field in self.table and field in wanted]
+            idate = header.index("date")
+            first = start.strftime("%Y-%m-%d") if start is not None else None
+            last = end.strftime("%Y-%m-%d") if end is not None else None
+            while True:
+                rows = list(itertools.islice(reader, chunk_size))
+                if not rows:
+                    break
+                # даты в формате ISO можно сравнивать как строки
+                if first is not None:
+                    rows = [row for row in rows if row[idate] >= first]
+                if last is not None:
+                    rows = [row for row in rows if row[idate] <= last]
+                if not rows:
+                    continue
+                values = zip(*rows)
+                loaded = set()
+                for pos, field in columns:
+                    column = self.table[field]
+                    if isinstance(column, CodeColumn):
+                        column.extend(value.decode("utf-8") for value in values[pos])
+                    else:
+                        column.extend(values[pos])
+                    loaded.add(field)
                 for field in self.tbody:
-                    try:
-                        row.append(self.table[field][i].encode("utf-8"))
-                    except AttributeError:
-                        print "Couldn't convert value: ", self.table[field][i],\
-                              " from field: ", field, " idx: ", i
-                        row.append(str(self.table[field][i]).encode("utf-8"))
-                writer.writerow(row)
-
-    def parse_file(self, fname):
-        raise NotImplemented
+                    if field not in loaded:
+                        self.table[field].extend([None]*len(rows))
+        self.update_index()
+        if len(self._stamps) > first_row:
+            last = from_stamp(max(self._stamps[first_row:]))
+            self.date = datetime.datetime(last.year, last.month, 1)
+
+    def save_snapshot(self, fname, compress=False):
+        """
+        Сохраняет таблицу в двоичный столбцовый снимок fname.
+        Формат: SNAPSHOT_MAGIC, длина заголовка (uint32 little-endian),
+        заголовок в json (схема, число строк, интервал времени, смещения
+        столбцов), затем данные столбцов, выровненные по 8 байт:
+            float64 - массив double, code - массив int32 кодов (категории
+            в заголовке), время - массив float64 секунд от начала эпохи.
+        compress - сжимать каждый столбец zlib
+        """
+        self.update_index()
+        blocks = [("time", "stamps", array.array('d', self._stamps), None)]
+        for field in self.tbody:
+            column = self.table[field]
+            if isinstance(column, CodeColumn):
+                blocks.append((field, "code", column.codes, column.categories))
+            else:
+                blocks.append((field, "float64", column.data, None))
+        columns = []
+        datas = []
+        offset = 0
+        for name, kind, data, categories in blocks:
+            data = data.tostring()
+            if compress:
+                data = zlib.compress(data)
+            data += b"\0"*(-len(data) % 8)
+            column = {"name": name, "type": kind, "offset": offset, "size": len(data)}
+            if categories is not None:
+                column["categories"] = categories
+            columns.append(column)
+            datas.append(data)
+            offset += len(data)
+        stamps = self._stamps
+        header = {"version": 1,
+                  "station": self.__class__.__name__,
+                  "city": getattr(self, "city", None),
+                  "rows": len(stamps),
+                  "start": from_stamp(min(stamps)).isoformat() if stamps else None,
+                  "end": from_stamp(max(stamps)).isoformat() if stamps else None,
+                  "byteorder": sys.byteorder,
+                  "compression": "zlib" if compress else None,
+                  "columns": columns}
+        header = json.dumps(header).encode("utf-8")
+        header += b" "*(-(len(SNAPSHOT_MAGIC)+4+len(header)) % 8)
+        tmp = fname+".tmp"
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack(b"<I", len(header)))
+            f.write(header)
+            for data in datas:
+                f.write(data)
+        replace_file(tmp, fname)
+
+    def load_snapshot(self, fname):
+        """
+        Загружает таблицу из снимка fname (см. save_snapshot) вместо текущей.
+        Снимок другого города не загружается (ValueError).
+        Текущим месяцем self.date становится последний месяц снимка.
+        Файл отображается в память, столбцы копируются из него целиком,
+        индексы восстанавливаются по сохраненному времени без разбора дат
+        """
+        with open(fname, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header, start = read_snapshot_header(mm)
+            city = getattr(self, "city", None)
+            if header["city"] != city:
+                raise ValueError("Snapshot of %s, not %s" % (header["city"], city))
+            swap = header["byteorder"] != sys.byteorder
+            table = {}
+            stamps = None
+            for column in header["columns"]:
+                data = mm[start+column["offset"]:start+column["offset"]+column["size"]]
+                if header["compression"] == "zlib":
+                    data = zlib.decompress(data)
+                typecode = 'i' if column["type"] == "code" else 'd'
+                values = array.array(typecode)
+                values.fromstring(data[:header["rows"]*values.itemsize])
+                if swap:
+                    values.byteswap()
+                if column["name"] == "time":
+                    stamps = array.array('l', (int(stamp) for stamp in values))
+                elif column["type"] == "code":
+                    table[column["name"]] = CodeColumn.from_codes(values, column["categories"])
+                else:
+                    table[column["name"]] = FloatColumn.from_array(values)
+        finally:
+            mm.close()
+        for field in self.tbody:
+            if field not in table:
+                table[field] = self.new_column(field, [None]*header["rows"])
+        self.table = table
+        self.drop_index()
+        self._indexed_dates = table["date"]
+        self._stamps = stamps
+        self.index_stamps(0)
+        if stamps:
+            last = from_stamp(max(stamps))
+            self.date = datetime.datetime(last.year, last.month, 1)
+        return header
+
+    def get_rows(self, day):
+        """
+        Возвращает список интервалов [start, end) строк таблицы для дня day
+        """
+        self.update_index()
+        return self._days.get(day, [])
 
     def get_list(self, day, field):
         """
         Возвращает поле field для дня day
         """
+        column = self.table[field]
         tempVal = []
-
-        for idx, date in enumerate(self.table["date"]):
-            syear, smonth, sday = date.split('-')
-            d = datetime.datetime(year=int(syear), month=int(smonth), day=int(sday))
-            #if syear == self.year and smonth == self.month and sday == day:
-            if d == day:
-                tempVal.append(self.table[field][idx])
-
+        for start, end in self.get_rows(day):
+            tempVal.extend(column[start:end])
         return tempVal
 
     def get(self, day, field, fnct=float):
         #print "Field: ", field
         #print "Day: ", day        
-        idx = self.get_date_month().index(day)
+        try:
+            idx = self.update_index()[to_stamp(day)]
+        except KeyError:
+            raise ValueError("%s is not in table" % day)
         #print "Idx: ", idx
         #print self.table[field]
         param = fnct(self.table[field][idx])
@@ -141,7 +1015,7 @@ class MeteoStation(object):
         """
         Возвращает среднее значения параметра дня day
         """
-        tempVal = map(float, self.get_list(day, param))
+        tempVal = self.get_list(day, param)
         try:
             return sum(tempVal)/float(len(tempVal))
         except:
@@ -151,7 +1025,7 @@ class MeteoStation(object):
         """
         Возвращает экстремум (max or min) значение параметра для всего периода
         """                        
-        tempVal = map(float, self.table[field])
+        tempVal = self.table[field].tolist()
         extrVal = extr(tempVal)
         idxVal = tempVal.index(extrVal)        
         try:
@@ -163,7 +1037,7 @@ class MeteoStation(object):
         """
         Возвращает среднюю температуру дня day
         """
-        tempVal = map(float, self.get_list(day, "temperature"))
+        tempVal = self.get_list(day, "temperature")
         try:
             return sum(tempVal)/float(len(tempVal))
         except:
@@ -173,7 +1047,7 @@ class MeteoStation(object):
         """
         Возвращает среднюю температуру дня day
         """
-        tempVal = map(float, self.get_list(day, "presure"))
+        tempVal = self.get_list(day, "presure")
         try:
             return sum(tempVal)/float(len(tempVal))
         except:
@@ -199,23 +1073,33 @@ class MeteoStation(object):
         '''
         Возвращает список содержащий время в формате datetime.datetime для дня day
         '''
-        dates   = self.get_list(day, "date")
-        hours   = self.get_list(day, "hour")
-        minutes = self.get_list(day, "min")
-
-        return self.convert_date(dates, hours, minutes)
+        dateVal = []
+        for start, end in self.get_rows(day):
+            dateVal.extend(map(from_stamp, self._stamps[start:end]))
+        return dateVal
 
     def get_date_month(self):
         """
         Возвращает список содержащий дату для текущего месяца в формате datetime.datetime
         """
-        dates   = self.table["date"]
-        hours   = self.table["hour"]
-        minutes = self.table["min"]
-        #print dates, hours, minutes
-        return self.convert_date(dates, hours, minutes)
+        self.update_index()
+        return map(from_stamp, self._stamps)
+
+    def field_series(self, field, start=None, end=None):
+        """
+        Возвращает (моменты, значения) параметра field для наблюдений
+        с start (включительно) по end (не включительно) в хронологическом порядке
+        """
+        self.update_index()
+        low = to_stamp(start) if start is not None else None
+        high = to_stamp(end) if end is not None else None
+        column = self.table[field]
+        series = sorted((stamp, column[idx]) for idx, stamp in enumerate(self._stamps)
+                        if (low is None or stamp >= low) and (high is None or stamp < high))
+        return [stamp for stamp, value in series], [value for stamp, value in series]
 
     def plot_temp(self, tempVal, aver_temp, dateVal, title, xlabel="Days", ylabel="Temperature", label="Temperature"):
+        load_pylab()
         pylab.title(title)
         pylab.xlabel(xlabel)
         pylab.ylabel(ylabel)
@@ -229,7 +1113,7 @@ class MeteoStation(object):
         """
         Построение графика изменения температуры для дня day
         """
-        tempVal = map(float, self.get_list(day, "temperature"))
+        tempVal = self.get_list(day, "temperature")
         aver_temp = self.get_avr_param(day, "temperature")
         dateVal = self.get_date_day(day)
         title   = 'Day by Day Temperature in '+self.city+' in '+unicode(day.strftime("%d%B%Y"))
@@ -240,7 +1124,7 @@ class MeteoStation(object):
         Построение графика изменения температуры для текущего месяца
         """
         #print self.table["temperature"]
-        tempVal = map(float, self.table["temperature"])
+        tempVal = self.table["temperature"].tolist()
         aver_temp = sum(tempVal)/float(len(tempVal))
         dateVal = self.get_date_month()
         title   = 'Day by Day Temperature in '+self.city+' in '+self.date.strftime("%B")+' '+self.date.strftime("%Y")
@@ -250,7 +1134,7 @@ class MeteoStation(object):
         """
         Построение графика изменения давления для дня day
         """
-        tempVal = map(float, self.get_list(day, "presure"))
+        tempVal = self.get_list(day, "presure")
         aver_temp = self.get_avr_param(day, "presure")
         dateVal = self.get_date_day(day)
         title   = 'Day by Day Presure in '+self.city+' in '+day.strftime("%d")+' '+day.strftime("%B")+' '+day.strftime("%Y")
@@ -260,7 +1144,7 @@ class MeteoStation(object):
         """
         Построение графика изменения давления для текущего месяца
         """
-        tempVal = map(float, self.table["presure"])
+        tempVal = self.table["presure"].tolist()
         aver_temp = sum(tempVal)/float(len(tempVal))
         dateVal = self.get_date_month()
         title   = 'Day by Day Presure in '+self.city+' in '+self.date.strftime("%B")+' '+self.date.strftime("%Y")
@@ -270,7 +1154,7 @@ class MeteoStation(object):
         """
         Построение графика изменения параметра field
         """        
-        tempVal = map(float, self.table[field])
+        tempVal = self.table[field].tolist()
         aver_temp = sum(tempVal)/float(len(tempVal))        
         dateVal = self.get_date_month()
         maxField, maxDateIdx = self.get_extremum_field(field)
@@ -279,6 +1163,7 @@ class MeteoStation(object):
         minDate = dateVal[minDateIdx]
         title   = 'Day by Day '+field.upper()+' in '+self.city+' in '+self.date.strftime("%B")+' '+self.date.strftime("%Y")
         #self.plot_temp(tempVal, aver_temp, dateVal, title)
+        load_pylab()
         pylab.title(title)
         pylab.xlabel(r"Days")
         pylab.ylabel(field)
@@ -312,14 +1197,18 @@ class MeteoProg(MeteoStation):
     """
     Получение метеоданных с сайте http://www.meteoprog.ua
     """
-    def __init__(self, city="Dnipropetrovsk"):
+    def __init__(self, city="Dnipropetrovsk", site="http://www.meteoprog.ua", cache=None):
         """
-        city - город, например Dnipropetrovsk
+        city  - город, например Dnipropetrovsk
+        site  - адрес сайта (для тестов - локальный сервер)
+        cache - кэш страниц (ResponseCache), по умолчанию default_cache(),
+                False - загружать страницы без кэша
         """
         MeteoStation.__init__(self)
         self.city = city
+        self.cache = default_cache() if cache is None else cache
         # базовая страница (без года и месяца)
-        self.mainpage = "http://www.meteoprog.ua/ru/fwarchive/"+city
+        self.mainpage = site+"/ru/fwarchive/"+city
 
     def parse(self, date):
         """
@@ -331,84 +1220,255 @@ class MeteoProg(MeteoStation):
             month - месяц, например, 01
         Результат записывается в словарь self.table
         """
+        self.parse_month(date, self.fetch(date))
+
+    def fetch_month(self, date):
+        return self.fetch(date)
+
+    def parse_month(self, date, html):
         self.date = date
         self.year  = self.date.strftime("%Y") #year
         self.month = self.date.strftime("%m") #month
-        days_of_month = calendar.monthrange(int(self.year), int(self.month))[1] # дней в месяце
-        url = self.mainpage+"/"+self.year+"/"+self.month+"/dayofset/01-"+str(days_of_month)+"/"
+        self.parse_html(html)
+
+    def parse_range(self, start, end, workers=4):
+        """
+        Считывание и парсинг данных за месяцы с start по end включительно.
+        Страницы загружаются параллельно, не более workers одновременно,
+        разбираются по мере поступления и добавляются в self.table
+        в хронологическом порядке
+        """
+        dates = months(start, end)
+        if not dates:
+            return
+        pool = ThreadPool(min(workers, len(dates)))
+        try:
+            # imap возвращает страницы в порядке месяцев
+            for date, html in zip(dates, pool.imap(self.fetch, dates)):
+                self.parse_month(date, html)
+        finally:
+            pool.terminate()
+
+    def month_url(self, date):
+        """
+        Адрес страницы архива за месяц date
+        """
+        days_of_month = calendar.monthrange(date.year, date.month)[1] # дней в месяце
+        return self.mainpage+"/"+date.strftime("%Y/%m")+"/dayofset/01-"+str(days_of_month)+"/"
+
+    def fetch(self, date):
+        """
+        Загружает страницу архива за месяц date
+        """
+        url = self.month_url(date)
         print url
-        # парисм данные
         try:
+            if self.cache:
+                return self.cache.fetch(url, self.city, date)
             page = urllib2.urlopen(url)
-            html = page.read()
+            return page.read()
         except:
             raise NotPage
-        #print html
-        soup = BeautifulSoup(html, from_encoding="utf-8")
+
+    def parse_html(self, html):
+        """
+        Парсинг страницы архива, строки добавляются в self.table.
+        Дерево не строится: текст ячеек таблицы архива поступает из
+        потокового парсера (iter_table_rows) прямо в столбцы
+        """
+        start = len(self.table["date"])
+        for row in iter_table_rows(html):
+            # номер колонки соответствует полю self.tbody
+            for field, cell in zip(self.tbody, row):
+                self.table[field].append(cell)
+        self.compute_local(start=start)
+        self.update_index()
+
+    def parse_soup(self, html):
+        """
+        Парсинг страницы архива через дерево bs4, строки добавляются в self.table.
+        Дерево строится только для таблицы архива, остальная страница
+        (меню, реклама, скрипты) пропускается при разборе.
+        Дерево только читается, поэтому строится в режиме read_only
+        """
+        only_archive = SoupStrainer("table", { "class" : "archive_table" })
+        soup = BeautifulSoup(html, from_encoding="utf-8", parse_only=only_archive,
+                             read_only=True)
         archive_table = soup.find("table", { "class" : "archive_table" })
+        if archive_table is None:
+            raise NotPage
         #print archive_table
+        start = len(self.table["date"])
         for tr in archive_table.findAll('tr'):
-            #print tr
-            n = 0 # номер колонки
-            for td in tr.findAll('td'):
-                #print n, self.tbody[n]
-                self.table[self.tbody[n]].append(td.get_text())
-                if self.tbody[n] == "temperature":
-                    t = float(td.get_text())                    
-                if self.tbody[n] == "presure":
-                    pres = float(td.get_text())
-                    self.table["local presure"].append(self.local_press(pres, t))
-                if self.tbody[n] == "speed wind":
-                    _td = td.get_text()
-                    try:
-                        speed = float(_td)
-                    except ValueError:
-                        print "Could not convert string ", _td, " to float"
-                        speed = 0
-                        #sys.exit(0)
-                    self.table["local speed"].append(self.local_speed(speed))
-                n+=1
+            # номер колонки соответствует полю self.tbody
+            for field, td in zip(self.tbody, tr.findAll('td')):
+                self.table[field].append(td.get_text())
         #print self.table           
+        self.compute_local(start=start)
+        self.update_index()
+
+class GapFiller(object):
+    """
+    Заполнение пропусков в таблице станции.
+    Пропуски собираются во время разбора (add) и заполняются одним
+    проходом после него (fill). Источники перебираются по порядку:
+        "meteoprog"   - значение из архива meteoprog.ua за то же время;
+                        каждый месяц загружается один раз в общий MeteoProg
+        "interpolate" - линейная интерполяция по времени между соседними
+                        известными значениями
+    Оставшиеся пропуски получают значение по умолчанию
+    """
+    def __init__(self, city="Dnipropetrovsk", sources=("meteoprog", "interpolate"), meteoprog=None):
+        self.sources = sources
+        self.meteoprog = MeteoProg(city=city) if meteoprog is None else meteoprog
+        # месяцы, уже загруженные в self.meteoprog
+        self.months = set()
+        # пропуски: (номер строки, время, поле, значение по умолчанию)
+        self.gaps = []
+
+    def add(self, idx, date, field, default):
+        """
+        Запоминает пропуск поля field в строке idx на время date
+        """
+        self.gaps.append((idx, date, field, default))
+
+    def fill(self, station):
+        """
+        Заполняет собранные пропуски в таблице станции station
+        """
+        gaps, self.gaps = self.gaps, []
+        for source in self.sources:
+            if not gaps:
+                break
+            if source == "meteoprog":
+                gaps = self.from_meteoprog(station, gaps)
+            elif source == "interpolate":
+                gaps = self.interpolate(station, gaps)
+            else:
+                raise ValueError("Unknown source: %s" % source)
+        for idx, date, field, default in gaps:
+            print >> sys.stderr, "Failed: set", field, "at", date, "to default", default
+            station.table[field][idx] = default
+
+    def from_meteoprog(self, station, gaps):
+        mp = self.meteoprog
+        for year, month in sorted(set((date.year, date.month) for _, date, _, _ in gaps)):
+            if (year, month) in self.months:
+                continue
+            self.months.add((year, month))
+            print >> sys.stderr, "Try get from meteoprog.com.ua"
+            try:
+                mp.parse(datetime.datetime(year, month, 1))
+            except NotPage:
+                print >> sys.stderr, "Failed to load", year, month
+        rest = []
+        for gap in gaps:
+            idx, date, field, default = gap
+            try:
+                value = mp.get(day=date, field=field)
+            except ValueError:
+                value = float("nan")
+            if math.isnan(value):
+                rest.append(gap)
+            else:
+                station.table[field][idx] = value
+        return rest
+
+    def interpolate(self, station, gaps):
+        stamps = station._stamps
+        rest = []
+        for gap in gaps:
+            idx, date, field, default = gap
+            column = station.table[field]
+            before = idx-1
+            while before >= 0 and math.isnan(column[before]):
+                before -= 1
+            after = idx+1
+            while after < len(column) and math.isnan(column[after]):
+                after += 1
+            if before < 0 or after >= len(column):
+                rest.append(gap)
+                continue
+            span = stamps[after] - stamps[before]
+            w = float(stamps[idx] - stamps[before])/span if span else 0.
+            column[idx] = column[before] + w*(column[after] - column[before])
+        return rest
 
 class MeteoRP5(MeteoStation):
     """
     Получение данных с сайта http://rp5.ua
     Данные представлены в файле csv
     """
-    def __init__(self):
+    def __init__(self, csvfile=None, filler=None):
+        """
+        csvfile - файл с данными, по умолчанию data.csv рядом с модулем
+        filler  - заполнение пропусков (GapFiller), по умолчанию GapFiller()
+        """
         MeteoStation.__init__(self)
-        enc = sys.getfilesystemencoding()
-        self.csvfile = os.path.join(os.path.dirname(__file__).decode(enc), u"data.csv")
+        if csvfile is None:
+            enc = sys.getfilesystemencoding()
+            csvfile = os.path.join(os.path.dirname(__file__).decode(enc), u"data.csv")
+        self.csvfile = csvfile
         #print self.csvfile
         self.csv = open(self.csvfile, 'rb')
         self.dialect = csv.Sniffer().sniff(self.csv.read(1024))
         self.city = "Dnipropetrovsk"
+        self.filler = GapFiller(self.city) if filler is None else filler
+        # смещения блоков строк по месяцам (см. month_index)
+        self.offsets = None
 
     def __del__(self):
         self.csv.close()
 
-    def getMeteoprogOrSetDefault(self, day, param, default):
-        print >> sys.stderr, "Try get from meteoprog.com.ua"
-        mp = MeteoProg(city='Dnipropetrovsk')
-        mp.parse(date=day)
-        p = mp.get(day=day, field=param)
-        if p is not None:
-            print >> sys.stderr, "Succesfull: ", p
-            date = p            
-        else:
-            print >> sys.stderr, "Failed: set to default "+default
-            date = default
-        
-        self.table[param].append(date)
-        t = mp.get(day=day, field="temperature")
-        if param == "presure":
-            lpres = self.local_press(date, t)
-            self.table["local presure"].append(lpres)
-        if param == "speed wind":
-            lspeed = self.local_speed(date)
-            self.table["local speed"].append(lspeed)
-            
-        pass
+    def month_index(self):
+        """
+        Возвращает словарь "YYYY-MM" -> список интервалов [start, end)
+        смещений в байтах строк этого месяца в файле csv.
+        Индекс строится один раз и сохраняется рядом с файлом (<csvfile>.idx),
+        при изменении размера или времени модификации файла строится заново
+        """
+        stat = os.stat(self.csvfile)
+        if self.offsets is not None and self.offsets["mtime"] == stat.st_mtime \
+           and self.offsets["size"] == stat.st_size:
+            return self.offsets["months"]
+        idxfile = self.csvfile+".idx"
+        try:
+            with open(idxfile, "rb") as f:
+                offsets = json.load(f)
+            if offsets["mtime"] == stat.st_mtime and offsets["size"] == stat.st_size:
+                self.offsets = offsets
+                return offsets["months"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        months = {}
+        delimiter = str(self.dialect.delimiter)
+        with open(self.csvfile, "rb") as f:
+            pos = 0
+            for line in iter(f.readline, b""):
+                end = pos+len(line)
+                first = line.split(delimiter, 1)[0].strip(b'"')
+                if first[:1].isdigit():
+                    # ДД.ММ.ГГГГ ЧЧ:ММ
+                    key = first[6:10]+"-"+first[3:5]
+                    ranges = months.setdefault(key, [])
+                    if ranges and ranges[-1][1] == pos:
+                        ranges[-1][1] = end
+                    else:
+                        ranges.append([pos, end])
+                pos = end
+        self.offsets = {"mtime": stat.st_mtime, "size": stat.st_size, "months": months}
+        try:
+            write_file(idxfile, json.dumps(self.offsets))
+        except (IOError, OSError):
+            print >> sys.stderr, "Couldn't save index "+idxfile
+        return months
+
+    def fetch_month(self, date):
+        data = []
+        for begin, end in self.month_index().get(date.strftime("%Y-%m"), []):
+            self.csv.seek(begin)
+            data.append(self.csv.read(end-begin))
+        return b"".join(data)
 
     def parse(self, date):
         """
@@ -448,8 +1508,12 @@ class MeteoRP5(MeteoStation):
         self.year  = self.date.strftime("%Y")#year
         self.month = self.date.strftime("%m")#month
 
-        self.csv.seek(0) # переходим на начало
-        spamreader = csv.reader(self.csv, dialect=self.dialect)
+        start = len(self.table["date"])
+        lines = []
+        for begin, end in self.month_index().get(date.strftime("%Y-%m"), []):
+            self.csv.seek(begin) # переходим на начало блока месяца
+            lines.extend(self.csv.read(end-begin).splitlines(True))
+        spamreader = csv.reader(lines, dialect=self.dialect)
         for row in spamreader:
             #if row[0][0] != u'#' and row[0][0] !=u"М":
             if row[0][0].isdigit():
@@ -469,34 +1533,35 @@ class MeteoRP5(MeteoStation):
                     try: # пробуем преобразовать в вещественное
                         pres = float(row[2])
                         self.table["presure"].append(pres)
-                        lpres = self.local_press(pres, t)
-                        self.table["local presure"].append(lpres)
-                    except: # если ошибка - устанавливаем по умолчанию
+                    except: # если ошибка - заполняем после разбора
                         print >> sys.stderr, row[0]
                         print >> sys.stderr, "Can't convert "+row[2]+" to float"
-                        self.getMeteoprogOrSetDefault(day=d, param="presure", default=750.)
+                        self.filler.add(len(self.table["presure"]), d, "presure", 750.)
+                        self.table["presure"].append(None)
                     try:
                         self.table["humidity"].append(float(row[5]))
                     except:
                         print >> sys.stderr, row[0]
                         print >> sys.stderr, "Can't convert "+row[5]+" to float"
-                        self.getMeteoprogOrSetDefault(day=d, param="humidity", default=100.)
-                        #self.table["humidity"].append(100.)
+                        self.filler.add(len(self.table["humidity"]), d, "humidity", 100.)
+                        self.table["humidity"].append(None)
                     self.table["direct wind"].append(row[6])
                     speed = float(row[7])
                     self.table["speed wind"].append(speed)
-                    lspeed = self.local_speed(speed)
-                    self.table["local speed"].append(lspeed)
-                else:
-                    if date.year > int(syear) and date.month > int(smonth):
-                        #print "break at : ", syear, "/", smonth
-                        break
-                    else:
-                        continue
-                        
+                    self.table["precipitation"].append(None)
+        # интерполяция пропусков использует индекс времени
+        self.update_index()
+        self.filler.fill(self)
+        self.compute_local(start=start)
+
 class PogodaBy(MeteoStation):
-    def __init__(self):
+    def __init__(self, base_url="http://pogoda.by/zip/"):
+        """
+        base_url - адрес архивов (для тестов - локальный сервер)
+        """
         MeteoStation.__init__(self)
+        self.downloader = ZipDownloader(base_url)
+        self.press_scale = 0.75 # из гПа в мм. рт. ст.
         self.dsource = "pogoda.by" # пака с данными
         self.city = "Dnipropetrovsk"
     
@@ -512,27 +1577,26 @@ class PogodaBy(MeteoStation):
     
     def has_local_date(self, year, month):
         """
-        Проверяет наличие файла данных
+        Проверяет наличие файла данных.
+        Оборванный при загрузке архив не имеет оглавления и не считается
         """        
         zip_file = self.zip_name(year, month)
-        if os.path.isfile(zip_file):
+        if os.path.isfile(zip_file) and zipfile.is_zipfile(zip_file):
             return True
         else:
             return False
     
     def download_data(self, year, month):
-        syear = str(year)
-        smonth = str(month)
-        if month < 10:
-            smonth = "0"+str(month)
-        base_url = "http://pogoda.by/zip/"
-        citi_code = "34504"
-        url = base_url+syear+"/"+citi_code+"_"+syear+"-"+smonth+".zip"
-        zip_name = self.zip_name(year, month)
-        zipfile = urllib2.urlopen(url)
+        self.downloader.download([(year, month, self.zip_name(year, month))])
 
-        with open(zip_name, 'w') as f: 
-            f.write(zipfile.read())        
+    def download_range(self, start, end):
+        """
+        Загружает архивы за месяцы с start по end включительно,
+        которых нет локально или которые повреждены
+        """
+        jobs = [(date.year, date.month, self.zip_name(date.year, date.month))
+                for date in months(start, end)]
+        return self.downloader.download(jobs)
     
     def unzip(self, year, month):
         zip_name = self.zip_name(year, month)
@@ -544,6 +1608,23 @@ class PogodaBy(MeteoStation):
             print ('ERROR: Did not find %s in zip file' % csv_file)
         else:            
             return data.decode("cp1251")        
+
+    def iter_rows(self, zip_name):
+        """
+        Построчно читает csv файл из архива zip_name и возвращает строки,
+        разбитые на поля. Архив не распаковывается в память целиком:
+        данные читаются из zip потоком, каждая строка декодируется отдельно
+        (cp1251 - однобайтовая кодировка)
+        """
+        zfile = zipfile.ZipFile(zip_name, "r")
+        try:
+            member = zfile.open(zfile.namelist()[0])
+            for line in member:
+                line = line.decode("cp1251").rstrip("\r\n")
+                if line:
+                    yield line.split(";")
+        finally:
+            zfile.close()
     
     def fnct_speed(self, date):
         s = unicode(date)        
@@ -552,6 +1633,17 @@ class PogodaBy(MeteoStation):
         else:
             return float(s)
     
+    def fetch_month(self, date):
+        """
+        Архив за месяц; архив незакончившегося месяца загружается заново
+        """
+        fname = self.zip_name(date.year, date.month)
+        if not self.has_local_date(date.year, date.month) \
+           or not is_month_closed(date, time.time()):
+            self.downloader.fetch(date.year, date.month, fname)
+        with open(fname, "rb") as f:
+            return f.read()
+
     def parse(self, date):
         year = date.year
         month = date.month        
@@ -562,31 +1654,799 @@ class PogodaBy(MeteoStation):
             self.download_data(year, month)
         
         if self.has_local_date(year, month):
-            data = self.unzip(year, month)            
-            for line in data.split('\n'):
-                row = line.split(";")
-                smonth = date.strftime("%m")
-                sday = row[0]
-                self.table["date"].append(str(year)+'-'+smonth+'-'+sday)
-                shour = str(row[1])
-                if float(row[1]) > 9:
-                    shour = "0"+str(row[1])
-                self.table["hour"].append(shour)
-                self.table["min"].append("00")
-                temp = row[2].replace(",", ".")
-                self.table["temperature"].append(temp)
-                direct = row[3]
-                self.table["direct wind"].append(direct)
-                speed = row[4]
-                self.table["speed wind"].append(speed)
-                humid = row[8]
-                self.table["humidity"].append(humid)
-                pres = row[9]
-                self.table["presure"].append(pres)
-                lpres = self.local_press(float(pres), float(temp))
-                self.table["local presure"].append(lpres*0.75) # из гПа в мм. рт. ст.
-                lspeed = self.local_speed(self.fnct_speed(speed))
-                self.table["local speed"].append(lspeed)
+            start = len(self.table["date"])
+            self.parse_rows(self.iter_rows(self.zip_name(year, month)), date)
+            self.compute_local(start=start)
+            self.update_index()
+
+    def load_range(self, start, end, processes=None):
+        """
+        Загрузка данных за месяцы с start по end включительно.
+        Недостающие архивы предварительно загружаются с pogoda.by,
+        затем архивы разбираются параллельно в пуле из processes процессов
+        (по умолчанию - по числу ядер) и добавляются в self.table
+        в хронологическом порядке
+        """
+        dates = months(start, end)
+        if not dates:
+            return
+        missing = [date for date in dates if not self.has_local_date(date.year, date.month)]
+        if missing:
+            print ("Download data from pogoda.by...")
+            self.download_range(missing[0], missing[-1])
+        begin = len(self.table["date"])
+        pool = multiprocessing.Pool(processes)
+        try:
+            tables = pool.map(parse_pogoda_zip,
+                              [(self.zip_name(date.year, date.month), date) for date in dates])
+        finally:
+            pool.terminate()
+        for table in tables:
+            for field in self.tbody:
+                self.table[field].extend(table[field])
+        self.date = dates[-1]
+        self.compute_local(start=begin)
+        self.update_index()
+
+    def parse_rows(self, rows, date):
+        """
+        Добавляет в self.table строки rows архива за месяц date
+        (без пересчета местных давления и скорости)
+        """
+        year = date.year
+        smonth = date.strftime("%m")
+        for row in rows:
+            sday = row[0]
+            self.table["date"].append(str(year)+'-'+smonth+'-'+sday)
+            shour = str(row[1])
+            if float(row[1]) > 9:
+                shour = "0"+str(row[1])
+            self.table["hour"].append(shour)
+            self.table["min"].append("00")
+            # осадков в данных pogoda.by нет
+            self.table["precipitation"].append(None)
+            temp = row[2].replace(",", ".")
+            self.table["temperature"].append(temp)
+            direct = row[3]
+            self.table["direct wind"].append(direct)
+            speed = row[4]
+            self.table["speed wind"].append(self.fnct_speed(speed))
+            humid = row[8]
+            self.table["humidity"].append(humid)
+            pres = row[9]
+            self.table["presure"].append(pres)
+
+class PlotRenderer(object):
+    """
+    Отрисовка графиков параметров в файлы png без GUI (Agg).
+    Фигура, оси, линии и подписи создаются один раз, при отрисовке
+    очередного графика у них заменяются только данные и тексты
+    """
+    def __init__(self, size=(16, 9), dpi=80):
+        apply_plot_rc()
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.dates import date2num
+        self.date2num = date2num
+        self.figure = Figure(figsize=size, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        axes = self.axes = self.figure.add_subplot(111)
+        self.line, = axes.plot_date([], [], 'b-')
+        self.average, = axes.plot_date([], [], 'r-')
+        axes.grid(True)
+        axes.set_xlabel(r"Days")
+        arrowprops = dict(width=0.2, facecolor='black', shrink=0.05)
+        self.max_note = axes.annotate("", xy=(0, 0), xytext=(0, 0), arrowprops=arrowprops,
+                                      horizontalalignment='left', verticalalignment='bottom')
+        self.min_note = axes.annotate("", xy=(0, 0), xytext=(0, 0), arrowprops=arrowprops,
+                                      horizontalalignment='right', verticalalignment='top')
+        self.legend = None
+
+    def render(self, fname, title, field, stamps, values):
+        """
+        Рисует график значений values параметра field в моменты stamps
+        и сохраняет его в fname. Возвращает fname или None, если нет данных
+        """
+        points = [(stamp, value) for stamp, value in zip(stamps, values)
+                  if value is not None and not math.isnan(value)]
+        if not points:
+            return None
+        x = self.date2num([from_stamp(stamp) for stamp, value in points])
+        y = [value for stamp, value in points]
+        aver = sum(y)/float(len(y))
+        imax = max(range(len(y)), key=y.__getitem__)
+        imin = min(range(len(y)), key=y.__getitem__)
+        self.line.set_data(x, y)
+        self.average.set_data([x[0], x[-1]], [aver, aver])
+        self.line.set_label(field)
+        self.average.set_label("Average "+str(round(aver, 2)))
+
+        offset = ((x[-1] - x[0])/20, (y[imax] - y[imin])/50)
+        self.max_note.set_text('max = '+str(round(y[imax], 2)))
+        self.max_note.xy = (x[imax], y[imax])
+        self.max_note.set_position((x[imax]+offset[0], y[imax]+offset[1]))
+        self.min_note.set_text('min = '+str(round(y[imin], 2)))
+        self.min_note.xy = (x[imin], y[imin])
+        self.min_note.set_position((x[imin]-offset[0], y[imin]-offset[1]))
+
+        axes = self.axes
+        axes.set_title(title)
+        axes.set_ylabel(field)
+        if self.legend is None:
+            self.legend = axes.legend(loc=0)
+        else:
+            for text, line in zip(self.legend.get_texts(), (self.line, self.average)):
+                text.set_text(line.get_label())
+        axes.relim()
+        axes.autoscale_view()
+        self.canvas.print_png(fname)
+        return fname
+
+# отрисовщик процесса, создается при первом задании
+_renderer = None
+
+def render_plot_jobs(tasks):
+    """
+    Отрисовка графиков tasks (fname, title, field, stamps, values) в текущем процессе
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = PlotRenderer()
+    return [_renderer.render(*task) for task in tasks]
+
+def render_plots(jobs, out_dir, processes=None):
+    """
+    Пакетная отрисовка графиков в папку out_dir.
+    jobs - список (station, field, period), где period - (start, end)
+    (end не включается) или None для всех данных станции.
+    Ряды выбираются в текущем процессе, графики рисуются в пуле
+    из processes процессов (по умолчанию - по числу ядер),
+    по одной фигуре на процесс.
+    Файлы называются <класс>_<город>_<поле>_<начало>_<конец>.png
+    (<поле>_all.png - для всех данных).
+    Возвращает список созданных файлов
+    """
+    def bound(date):
+        if date is None:
+            return "all"
+        if date.time() == datetime.time():
+            return date.strftime("%Y-%m-%d")
+        return date.strftime("%Y-%m-%dT%H%M")
+    tasks = []
+    for station, field, period in jobs:
+        start, end = period if period is not None else (None, None)
+        stamps, values = station.field_series(field, start, end)
+        if not stamps:
+            continue
+        first = from_stamp(stamps[0])
+        suffix = "%s_%s" % (bound(start), bound(end)) if period is not None else "all"
+        name = "%s_%s_%s_%s.png" % (station.__class__.__name__, getattr(station, "city", ""),
+                                    field, suffix)
+        fname = os.path.join(out_dir, name.replace(" ", "_"))
+        title = 'Day by Day '+field.upper()+' in '+getattr(station, "city", "")+' in '+ \
+                first.strftime("%B")+' '+first.strftime("%Y")
+        tasks.append((fname, title, field, stamps, values))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+    if processes <= 1:
+        files = render_plot_jobs(tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            files = sum(pool.map(render_plot_jobs,
+                                 [tasks[i::processes] for i in range(processes)]), [])
+        finally:
+            pool.terminate()
+    return sorted(fname for fname in files if fname is not None)
+
+def default_store():
+    """
+    Папка store рядом с модулем - локальное хранилище для sync
+    """
+    enc = sys.getfilesystemencoding()
+    return os.path.join(os.path.dirname(__file__).decode(enc), "store")
+
+def sync(station, start, end, store=None):
+    """
+    Инкрементальная синхронизация данных станции station за месяцы
+    с start по end включительно с локальным хранилищем store
+    (по умолчанию default_store()).
+    В хранилище для каждого источника (класса станции и города) хранятся
+    снимок таблицы <класс>_<город>.snap и манифест <класс>_<город>.json:
+    для каждого месяца - хэш исходных данных и закончился ли месяц
+    к моменту загрузки.
+    Закончившиеся месяцы из манифеста не загружаются, для остальных
+    данные загружаются (fetch_month) и разбираются, только если хэш
+    изменился. Месяц без строк закончившимся не считается и загружается
+    снова. Строки обновленных месяцев заменяют старые, таблица
+    сохраняется в хранилище. В station загружается вся таблица хранилища.
+    При ошибке загрузки или разбора месяца месяцы, обработанные до нее,
+    сохраняются в хранилище, и ошибка передается дальше.
+    Возвращает список обновленных месяцев "YYYY-MM"
+    """
+    if store is None:
+        store = default_store()
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    name = "%s_%s" % (station.__class__.__name__, station.city)
+    snapshot = os.path.join(store, name+".snap")
+    manifest_file = os.path.join(store, name+".json")
+    manifest = {"months": {}}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, "rb") as f:
+            manifest = json.load(f)
+    if os.path.isfile(snapshot):
+        station.load_snapshot(snapshot)
+    # номер первой новой строки обновленного месяца
+    updated = {}
+    # номер первой строки месяца, который сейчас разбирается
+    parsing = None
+    try:
+        for date in months(start, end):
+            key = date.strftime("%Y-%m")
+            entry = manifest["months"].get(key)
+            if entry is not None and entry["closed"]:
+                continue
+            now = time.time()
+            data = station.fetch_month(date)
+            digest = hashlib.sha1(data).hexdigest()
+            if entry is None or entry["hash"] != digest:
+                parsing = len(station.table["date"])
+                station.parse_month(date, data)
+                rows = len(station.table["date"]) - parsing
+                if rows or entry is not None and entry.get("rows"):
+                    updated[key] = parsing
+                parsing = None
+            else:
+                rows = entry.get("rows", 0)
+            # месяц без данных (например, еще не выгруженный в файл rp5)
+            # загружается снова
+            closed = rows > 0 and is_month_closed(date, now)
+            manifest["months"][key] = {"hash": digest, "closed": closed,
+                                       "checked": now, "rows": rows}
+    finally:
+        if parsing is not None:
+            # строки месяца, разбор которого прервался, отбрасываются
+            for field in station.tbody:
+                station.table[field] = station.table[field].take(xrange(parsing))
+        if updated:
+            station.update_index()
+            stamps = station._stamps
+            rows = []
+            for idx, stamp in enumerate(stamps):
+                key = from_stamp(stamp).strftime("%Y-%m")
+                # старые строки обновленных месяцев отбрасываются
+                if key not in updated or idx >= updated[key]:
+                    rows.append(idx)
+            rows.sort(key=lambda idx: stamps[idx])
+            station.keep_rows(rows)
+            station.save_snapshot(snapshot, compress=True)
+        write_file(manifest_file, json.dumps(manifest, indent=1, sort_keys=True))
+    return sorted(updated)
+
+def parse_pogoda_zip(args):
+    """
+    Разбор одного архива pogoda.by в пуле процессов.
+    args - (имя zip файла, месяц), возвращает таблицу PogodaBy
+    """
+    zip_name, date = args
+    md = PogodaBy()
+    md.parse_rows(md.iter_rows(zip_name), date)
+    return md.table
+
+def local_server(handler):
+    """
+    Запускает локальный HTTP-сервер с обработчиком handler в отдельном потоке
+    """
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+    server = Server(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def archive_page(path):
+    """
+    Страница архива meteoprog.ua для локального сервера:
+    по три наблюдения в первые три дня месяца, температура равна номеру месяца
+    """
+    # /ru/fwarchive/<city>/<year>/<month>/dayofset/01-<days>/
+    year, month = path.split("/")[4:6]
+    rows = []
+    for day in range(1, 4):
+        for hour in ("06", "12", "18"):
+            rows.append("<tr><td>%s-%s-%02d</td><td>%s</td><td>00</td><td>0</td>"
+                        "<td>Ю-З</td><td>%d</td><td>%d</td><td>80</td><td>750</td></tr>"
+                        % (year, month, day, hour, day, int(month)))
+    return ('<html><body><table class="archive_table">'+"".join(rows)+
+            '</table></body></html>').encode("utf-8")
+
+class ArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Обработчик локального сервера, отдающий archive_page.
+    Запоминает пути запросов в requests и отвечает 304 на If-None-Match
+    """
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        etag = '"%s"' % self.path
+        if self.headers.getheader("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = archive_page(self.path)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def testParseRange():
+    server = local_server(ArchiveHandler)
+    try:
+        mp = MeteoProg(site="http://127.0.0.1:%d" % server.server_port, cache=False)
+        mp.parse_range(datetime.datetime(2010, 11, 1), datetime.datetime(2011, 2, 1), workers=3)
+        dates = mp.get_date_month()
+        assert len(dates) == 4*9
+        assert dates == sorted(dates)
+        assert mp.get(datetime.datetime(2010, 12, 2, 12), "temperature") == 12
+        assert mp.get(datetime.datetime(2011, 2, 3, 18), "speed wind") == 3
+    finally:
+        server.shutdown()
+
+def testTableRowParser():
+    row = ('<tr><td>2011-01-%02d</td><td>%s</td><td>00</td><td>0</td><td>%s</td>'
+           '<td>3</td><td>-1.5</td><td>80</td><td>750</td></tr>')
+    cells = [(1, "06", "Ю&#8209;З"), (1, "12", "С&#x412;&nbsp;"), (2, "06", "З &amp; Ю")]
+    page = ('<html><body><table class="menu"><tr><td>меню</td></tr></table>'
+            '<table class="archive_table">%s</table></body></html>')
+    rows = "".join(row % cell for cell in cells)
+    expected = [["2011-01-%02d" % day, hour, "00", "0", wind, "3", "-1.5", "80", "750"]
+                for (day, hour, _), wind in zip(cells, ["Ю\u2011З", "С\u0412\xa0", "З & Ю"])]
+    html = (page % rows).encode("utf-8")
+    # мелкие куски - ссылки на символы разрезаются между вызовами feed
+    assert list(iter_table_rows(html, chunk_size=7)) == expected
+    stream = MeteoProg(cache=False)
+    stream.parse_html(html)
+    soup = MeteoProg(cache=False)
+    soup.parse_soup(html)
+    for field in stream.tbody:
+        assert map(repr, stream.table[field]) == map(repr, soup.table[field]), field
+    # без </td> и </tr> (parse_soup с html.parser вкладывает такие ячейки
+    # друг в друга, поэтому сравнивается с разбором полной разметки)
+    html = (page % rows.replace("</td>", "").replace("</tr>", "")).encode("utf-8")
+    assert list(iter_table_rows(html, chunk_size=7)) == expected
+    # вложенная таблица: ее строки - не строки архива, текст - в ячейке
+    nested = rows.replace("<td>Ю&#8209;З</td>", "<td><table><tr><td>Ю&#8209;З</td></tr></table></td>")
+    assert nested != rows
+    assert list(iter_table_rows((page % nested).encode("utf-8"))) == expected
+    # нет таблицы архива
+    html = page.replace("archive_table", "other_table") % rows
+    try:
+        list(iter_table_rows(html.encode("utf-8")))
+    except NotPage:
+        pass
+    else:
+        assert False, "page without archive_table parsed"
+
+def testResponseCache():
+    import tempfile
+    import shutil
+    server = local_server(ArchiveHandler)
+    directory = tempfile.mkdtemp()
+    try:
+        site = "http://127.0.0.1:%d" % server.server_port
+        cache = ResponseCache(directory, ttl=0)
+        del ArchiveHandler.requests[:]
+        closed = datetime.datetime(2010, 1, 1)
+        current = datetime.datetime.utcnow()
+        for i in range(2):
+            mp = MeteoProg(site=site, cache=cache)
+            mp.parse(closed)
+            mp.parse(current)
+            assert len(mp.table["date"]) == 2*9
+        # закрытый месяц загружен один раз, текущий - перепроверен (304)
+        assert len(ArchiveHandler.requests) == 3
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+def testLoadRange():
+    md = PogodaBy()
+    for i in range(1, 13):
+        md.parse(datetime.datetime(year=2012, month=i, day=1))
+    bulk = PogodaBy()
+    bulk.load_range(datetime.datetime(2012, 1, 1), datetime.datetime(2012, 12, 1), processes=4)
+    for field in md.tbody:
+        # repr - чтобы NaN были равны
+        assert map(repr, md.table[field]) == map(repr, bulk.table[field]), field
+    assert md.get_date_month() == bulk.get_date_month()
+
+class ZipHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Обработчик локального сервера, отдающий архивы из папки pogoda.by
+    по адресам вида /zip/2011/34504_2011-01.zip.
+    Поддерживает постоянные соединения, запоминает пути запросов в requests
+    """
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        year, month = self.path.split("_")[-1][:-len(".zip")].split("-")
+        fname = PogodaBy().zip_name(int(year), int(month))
+        if not os.path.isfile(fname):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with open(fname, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def testZipDownloader():
+    import tempfile
+    import shutil
+    server = local_server(ZipHandler)
+    directory = tempfile.mkdtemp()
+    try:
+        downloader = ZipDownloader("http://127.0.0.1:%d/zip/" % server.server_port, workers=3)
+        jobs = [(2011, month, os.path.join(directory, "2011_%02d.zip" % month))
+                for month in range(1, 7)]
+        # оборванная загрузка
+        with open(PogodaBy().zip_name(2011, 2), "rb") as f:
+            write_file(jobs[1][2], f.read()[:1000])
+        del ZipHandler.requests[:]
+        assert len(downloader.download(jobs)) == 6
+        assert len(ZipHandler.requests) == 6
+        assert all(is_complete_zip(fname) for _, _, fname in jobs)
+        # все архивы целые - повторно не загружаются
+        assert downloader.download(jobs) == []
+        assert len(ZipHandler.requests) == 6
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+def testSnapshot():
+    import tempfile
+    import shutil
+    md = PogodaBy()
+    md.load_range(datetime.datetime(2011, 1, 1), datetime.datetime(2012, 12, 1))
+    directory = tempfile.mkdtemp()
+    try:
+        for compress in (False, True):
+            fname = os.path.join(directory, "pogoda.snap")
+            md.save_snapshot(fname, compress)
+            info = snapshot_info(fname)
+            assert info["rows"] == len(md.table["date"])
+            assert info["start"] == "2011-01-01T00:00:00"
+            loaded = PogodaBy()
+            loaded.load_snapshot(fname)
+            for field in md.tbody:
+                # repr - чтобы NaN были равны
+                values = lambda column: [repr(v) if isinstance(v, float) else v for v in column]
+                assert values(md.table[field]) == values(loaded.table[field]), field
+            day = datetime.datetime(2012, 6, 3)
+            assert loaded.get_date_day(day) == md.get_date_day(day)
+            assert loaded.get(day, "temperature") == md.get(day, "temperature")
+            assert loaded.date == datetime.datetime(2012, 12, 1)
+    finally:
+        shutil.rmtree(directory)
+
+def testParseFile():
+    enc = sys.getfilesystemencoding()
+    fname = os.path.join(os.path.dirname(__file__).decode(enc), "meteoprog.ua", "meteoprog.csv")
+    mp = MeteoProg(cache=False)
+    mp.parse_file(fname, chunk_size=1000)
+    day = datetime.datetime(2010, 1, 1, 3)
+    assert mp.get(day, "presure") == 748
+    assert mp.table["direct wind"][0].strip() == "СВ"
+    dates = mp.get_date_month()
+    assert dates[0] == datetime.datetime(2010, 1, 1, 0, 30)
+    assert mp.date == datetime.datetime(dates[-1].year, dates[-1].month, 1)
+    # только февраль, только температура
+    part = MeteoProg(cache=False)
+    part.parse_file(fname, start=datetime.datetime(2010, 2, 1),
+                    end=datetime.datetime(2010, 2, 28), fields=["temperature"])
+    feb = [date for date in dates if date.month == 2]
+    assert part.get_date_month() == feb
+    assert part.date == datetime.datetime(2010, 2, 1)
+    assert part.get_temp(datetime.datetime(2010, 2, 14)) == mp.get_temp(datetime.datetime(2010, 2, 14))
+    assert math.isnan(part.table["presure"][0])
+
+def write_rp5_csv(fname, start, end, missing=()):
+    """
+    Файл в формате выгрузки rp5 с наблюдениями каждые 3 часа за дни
+    с start по end включительно, строки - от последней к первой.
+    Температура - номер дня месяца, давление - 740 + час, влажность - 80.
+    missing - моменты, в которые давление и влажность не заполнены
+    """
+    lines = ['# Метеостанция Днепропетровск, Украина, WMO_ID=34504\n',
+             '# Кодировка: UTF-8\n',
+             '#\n',
+             '"Местное время в Днепропетровске";"T";"Po";"P";"Pa";"U";"DD";"Ff";"ff10";"ff3";"N";\n']
+    date = end + datetime.timedelta(hours=21)
+    while date >= start:
+        press, humidity = ("", "") if date in missing else (740+date.hour, 80)
+        lines.append('"%s";"%d";"%s";"%d";"0.1";"%s";"Ветер, дующий с юга";"3";"";"";"90%%";\n'
+                     % (date.strftime("%d.%m.%Y %H:%M"), date.day, press, 750+date.hour, humidity))
+        date -= datetime.timedelta(hours=3)
+    write_file(fname, "".join(lines).encode("utf-8"))
+
+def testSave():
+    import tempfile
+    import shutil
+    md = PogodaBy()
+    md.load_range(datetime.datetime(2011, 1, 1), datetime.datetime(2012, 12, 1))
+    first = PogodaBy()
+    first.load_range(datetime.datetime(2011, 1, 1), datetime.datetime(2011, 12, 1))
+    directory = tempfile.mkdtemp()
+    try:
+        for name in ("pogoda.csv", "pogoda.csv.gz"):
+            fname = os.path.join(directory, name)
+            assert first.save(fname) == len(first.table["date"])
+            # дописываются только строки 2012 года
+            assert md.save(fname, append=True) == len(md.table["date"])-len(first.table["date"])
+            assert md.save(fname, append=True) == 0
+            loaded = PogodaBy()
+            loaded.parse_file(fname)
+            assert loaded.get_date_month() == md.get_date_month()
+            for field in ("temperature", "presure", "speed wind", "direct wind"):
+                assert loaded.table[field][:] == md.table[field][:], field
+        # в таблице rp5 строки идут от новых к старым
+        csvfile = os.path.join(directory, "data.csv")
+        write_rp5_csv(csvfile, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 3, 31))
+        first = MeteoRP5(csvfile, GapFiller(sources=()))
+        md = MeteoRP5(csvfile, GapFiller(sources=()))
+        for date in months(datetime.datetime(2011, 1, 1), datetime.datetime(2011, 3, 1)):
+            if date.month < 3:
+                first.parse(date)
+            md.parse(date)
+        fname = os.path.join(directory, "rp5.csv")
+        first.save(fname)
+        # дописываются только строки марта
+        assert md.save(fname, append=True) == 31*8
+        loaded = MeteoStation()
+        loaded.parse_file(fname)
+        dates = loaded.get_date_month()
+        assert dates == sorted(md.get_date_month())
+        assert len(set(dates)) == len(dates) == 90*8
+        day = datetime.datetime(2011, 3, 5, 12)
+        assert loaded.get(day, "temperature") == 5 and loaded.get(day, "presure") == 752
+    finally:
+        shutil.rmtree(directory)
+
+def testMonthIndex():
+    import tempfile
+    import shutil
+    directory = tempfile.mkdtemp()
+    try:
+        csvfile = os.path.join(directory, "data.csv")
+        write_rp5_csv(csvfile, datetime.datetime(2010, 11, 1), datetime.datetime(2011, 3, 31))
+        dates = months(datetime.datetime(2010, 11, 1), datetime.datetime(2011, 3, 1))
+        # разбор по индексу совпадает с полным просмотром файла
+        with open(csvfile, "rb") as f:
+            scan = [datetime.datetime.strptime(line[1:17], "%d.%m.%Y %H:%M")
+                    for line in f if line[1:2].isdigit()]
+        md = MeteoRP5(csvfile, GapFiller(sources=()))
+        expected = []
+        for date in dates[1:4]:
+            md.parse(date)
+            expected.extend(stamp for stamp in scan
+                            if (stamp.year, stamp.month) == (date.year, date.month))
+        assert md.get_date_month() == expected
+        assert md.get(datetime.datetime(2011, 1, 15, 21), "temperature") == 15
+        assert sorted(md.month_index()) == [date.strftime("%Y-%m") for date in dates]
+        # индекс сохранен рядом с файлом и используется повторно
+        with open(csvfile+".idx", "rb") as f:
+            saved = json.load(f)
+        saved["months"]["1999-01"] = [[0, 1]]
+        write_file(csvfile+".idx", json.dumps(saved))
+        assert "1999-01" in MeteoRP5(csvfile, GapFiller(sources=())).month_index()
+        # изменилось время модификации - индекс строится заново
+        stat = os.stat(csvfile)
+        os.utime(csvfile, (stat.st_atime, stat.st_mtime+10))
+        assert "1999-01" not in MeteoRP5(csvfile, GapFiller(sources=())).month_index()
+        # изменился размер - тоже
+        saved["months"]["1999-01"] = [[0, 1]]
+        saved["mtime"] = os.stat(csvfile).st_mtime
+        write_rp5_csv(csvfile, datetime.datetime(2010, 11, 1), datetime.datetime(2011, 4, 30))
+        os.utime(csvfile, (saved["mtime"], saved["mtime"]))
+        write_file(csvfile+".idx", json.dumps(saved))
+        md = MeteoRP5(csvfile, GapFiller(sources=()))
+        index = md.month_index()
+        assert "1999-01" not in index and "2011-04" in index
+        md.parse(datetime.datetime(2011, 4, 1))
+        assert len(md.get_date_month()) == 30*8
+    finally:
+        shutil.rmtree(directory)
+
+def testGapFiller():
+    import tempfile
+    import shutil
+    server = local_server(ArchiveHandler)
+    directory = tempfile.mkdtemp()
+    try:
+        # meteoprog (archive_page): 1-3 числа в 06, 12 и 18 часов,
+        # давление 750, влажность 80
+        from_page = [datetime.datetime(2011, 1, 2, 12), datetime.datetime(2011, 2, 1, 6),
+                     datetime.datetime(2011, 2, 3, 18)]
+        # нет на странице - интерполяция между 06:00 (746) и 15:00 (755)
+        between = [datetime.datetime(2011, 1, 4, 9), datetime.datetime(2011, 1, 4, 12)]
+        # первая строка таблицы (rp5 - от новых к старым), соседа нет
+        first = datetime.datetime(2011, 1, 31, 21)
+        csvfile = os.path.join(directory, "data.csv")
+        write_rp5_csv(csvfile, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 2, 5),
+                      set(from_page+between+[first]))
+        site = "http://127.0.0.1:%d" % server.server_port
+        filler = GapFiller(meteoprog=MeteoProg(site=site, cache=False))
+        md = MeteoRP5(csvfile, filler)
+        del ArchiveHandler.requests[:]
+        md.parse(datetime.datetime(2011, 1, 1))
+        md.parse(datetime.datetime(2011, 2, 1))
+        # страница каждого месяца загружается один раз на все его пропуски
+        assert len(ArchiveHandler.requests) == 2
+        # meteoprog проверяется раньше интерполяции
+        for date in from_page:
+            assert md.get(date, "presure") == 750 and md.get(date, "humidity") == 80, date
+        assert [md.get(date, "presure") for date in between] == [749, 752]
+        assert [md.get(date, "humidity") for date in between] == [80, 80]
+        # значения по умолчанию
+        assert md.get(first, "presure") == 750 and md.get(first, "humidity") == 100
+        assert md.get(datetime.datetime(2011, 1, 4, 15), "presure") == 755
+        assert not any(math.isnan(value) for value in md.table["local presure"])
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+def testSync():
+    import tempfile
+    import shutil
+    server = local_server(ArchiveHandler)
+    store = tempfile.mkdtemp()
+    try:
+        md = PogodaBy()
+        assert len(sync(md, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 6, 1), store)) == 6
+        md = PogodaBy()
+        assert sync(md, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 12, 1), store) == \
+            ["2011-%02d" % month for month in range(7, 13)]
+        bulk = PogodaBy()
+        bulk.load_range(datetime.datetime(2011, 1, 1), datetime.datetime(2011, 12, 1))
+        assert md.get_date_month() == bulk.get_date_month()
+        # ничего не обновилось, но таблица и текущий месяц загружены
+        md = PogodaBy()
+        assert sync(md, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 12, 1), store) == []
+        assert md.date == datetime.datetime(2011, 12, 1)
+        assert md.get_date_month() == bulk.get_date_month()
+        assert md.table["temperature"][:] == bulk.table["temperature"][:]
+
+        site = "http://127.0.0.1:%d" % server.server_port
+        current = datetime.datetime.utcnow()
+        del ArchiveHandler.requests[:]
+        for i in range(2):
+            mp = MeteoProg(site=site, cache=False)
+            updated = sync(mp, datetime.datetime(2010, 12, 1), current, store)
+            # закрытые месяцы загружаются один раз, текущий - каждый раз,
+            # но не изменился и не разбирается повторно
+            assert len(updated) == (len(months(datetime.datetime(2010, 12, 1), current)) if i == 0 else 0)
+            assert len(mp.get_date_month()) == 9*len(months(datetime.datetime(2010, 12, 1), current))
+        assert len(ArchiveHandler.requests) == len(months(datetime.datetime(2010, 12, 1), current))+1
+        # у другого города свои снимок и манифест
+        kyiv = MeteoProg(city="Kyiv", site=site, cache=False)
+        updated = sync(kyiv, datetime.datetime(2010, 12, 1), current, store)
+        assert len(updated) == len(months(datetime.datetime(2010, 12, 1), current))
+        assert ArchiveHandler.requests[-1].startswith("/ru/fwarchive/Kyiv/")
+        assert len(kyiv.get_date_month()) == len(mp.get_date_month())
+        try:
+            kyiv.load_snapshot(os.path.join(store, "MeteoProg_Dnipropetrovsk.snap"))
+        except ValueError:
+            pass
+        else:
+            assert False, "snapshot of another city loaded"
+
+        # февраля еще нет в выгрузке rp5 - он загружается после повторной выгрузки
+        csvfile = os.path.join(store, "data.csv")
+        write_rp5_csv(csvfile, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 1, 31))
+        md = MeteoRP5(csvfile, GapFiller(sources=()))
+        assert sync(md, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 2, 1), store) == ["2011-01"]
+        write_rp5_csv(csvfile, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 2, 28))
+        md = MeteoRP5(csvfile, GapFiller(sources=()))
+        assert sync(md, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 2, 1), store) == ["2011-02"]
+        assert len(md.get_date_month()) == (31+28)*8
+
+        # ошибка в марте: январь и февраль уже сохранены, строки марта - нет
+        class FailingRP5(MeteoRP5):
+            fail = True
+            def parse_month(self, date, data):
+                MeteoRP5.parse_month(self, date, data)
+                if self.fail and date.month == 3:
+                    raise IOError("March is broken")
+        write_rp5_csv(csvfile, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 3, 31))
+        md = FailingRP5(csvfile, GapFiller(sources=()))
+        try:
+            sync(md, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 3, 1), store)
+        except IOError:
+            pass
+        else:
+            assert False, "error in sync is lost"
+        assert snapshot_info(os.path.join(store, "FailingRP5_Dnipropetrovsk.snap"))["rows"] == (31+28)*8
+        md = FailingRP5(csvfile, GapFiller(sources=()))
+        md.fail = False
+        assert sync(md, datetime.datetime(2011, 1, 1), datetime.datetime(2011, 3, 1), store) == ["2011-03"]
+        assert len(md.get_date_month()) == (31+28+31)*8
+    finally:
+        server.shutdown()
+        shutil.rmtree(store)
+
+def testRenderPlots():
+    import tempfile
+    import shutil
+    md = PogodaBy()
+    md.load_range(datetime.datetime(2011, 1, 1), datetime.datetime(2011, 3, 1))
+    periods = [(date, months(date, date + datetime.timedelta(days=31))[-1])
+               for date in months(datetime.datetime(2011, 1, 1), datetime.datetime(2011, 3, 1))]
+    jobs = [(md, field, period) for field in ("temperature", "local presure", "speed wind")
+            for period in periods + [None]]
+    # два города одного источника и два периода с одним началом
+    server = local_server(ArchiveHandler)
+    site = "http://127.0.0.1:%d" % server.server_port
+    stations = []
+    try:
+        for city in ("Dnipropetrovsk", "Kyiv"):
+            mp = MeteoProg(city=city, site=site, cache=False)
+            mp.parse_range(datetime.datetime(2011, 1, 1), datetime.datetime(2011, 2, 1))
+            stations.append(mp)
+    finally:
+        server.shutdown()
+    for mp in stations:
+        jobs += [(mp, "temperature", period) for period in
+                 [None, (datetime.datetime(2011, 1, 1), datetime.datetime(2011, 1, 3)),
+                  (datetime.datetime(2011, 1, 1), datetime.datetime(2011, 2, 1))]]
+    out_dir = tempfile.mkdtemp()
+    try:
+        files = render_plots(jobs, out_dir, 2)
+        assert len(set(files)) == len(jobs)
+        assert sorted(os.listdir(out_dir)) == sorted(os.path.basename(fname) for fname in files)
+        assert os.path.join(out_dir, "MeteoProg_Kyiv_temperature_2011-01-01_2011-01-03.png") in files
+        # график на переиспользованной фигуре совпадает с нарисованным на новой
+        single = os.path.join(out_dir, "single")
+        os.mkdir(single)
+        fname, = render_plots(jobs[-1:], single, 1)
+        with open(fname, "rb") as f:
+            data = f.read()
+        assert data.startswith(b"\x89PNG\r\n\x1a\n")
+        with open(os.path.join(out_dir, os.path.basename(fname)), "rb") as f:
+            assert f.read() == data
+    finally:
+        shutil.rmtree(out_dir)
+
+def testLightImport():
+    import subprocess
+    # загрузка и сохранение данных не импортируют matplotlib
+    script = ("import sys, datetime, tempfile, os, MeteoData\n"
+              "md = MeteoData.PogodaBy()\n"
+              "md.parse(datetime.datetime(2011, 1, 1))\n"
+              "fd, fname = tempfile.mkstemp()\n"
+              "os.close(fd)\n"
+              "md.save(fname)\n"
+              "os.remove(fname)\n"
+              "assert 'matplotlib' not in sys.modules and 'numpy' not in sys.modules\n"
+              "assert MeteoData.pylab is None\n")
+    enc = sys.getfilesystemencoding()
+    subprocess.check_call([sys.executable, "-c", script],
+                          cwd=os.path.dirname(os.path.abspath(__file__)).decode(enc))
 
 def testPogodaBy():
     md = PogodaBy()
@@ -642,3 +2502,16 @@ def test():
 if __name__ == "__main__":
     test()
     testPogodaBy()
+    testParseRange()
+    testTableRowParser()
+    testResponseCache()
+    testLoadRange()
+    testZipDownloader()
+    testSnapshot()
+    testParseFile()
+    testSave()
+    testMonthIndex()
+    testGapFiller()
+    testSync()
+    testRenderPlots()
+    testLightImport()
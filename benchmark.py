@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Замеры производительности загрузки и обработки метеоданных.
+
+    python benchmark.py [--repeat N] [--rp5-years N] [--output FILE]
+                        [--baseline FILE] [--threshold X] [--import-budget S]
+
+Данные для замеров:
+    bench/meteoprog_*.html - сохраненные страницы архива meteoprog.ua
+    pogoda.by/*.zip        - архивы pogoda.by
+    data.csv               - файл rp5, генерируется во временной папке,
+                             размер задается --rp5-years
+Результаты записываются в json (--output). Если задан --baseline,
+результаты сравниваются с ним: замер, ставший медленнее более чем
+в threshold раз, считается регрессией, и скрипт завершается с кодом 1.
+
+Отдельно замеряется время импорта MeteoData в новом процессе без
+построения графиков: оно не должно превышать --import-budget секунд,
+а matplotlib и numpy не должны импортироваться. Иначе код завершения 1
+"""
+from __future__ import unicode_literals
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import MeteoData
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, "bench")
+
+def make_rp5_csv(fname, years, seed=1):
+    """
+    Генерирует файл rp5 за years лет (с 2010 года) с наблюдениями каждые 3 часа.
+    Строки идут от последней к первой, как в выгрузке rp5
+    """
+    rnd = random.Random(seed)
+    start = datetime.datetime(2010, 1, 1)
+    date = datetime.datetime(2010+years, 1, 1) - datetime.timedelta(hours=3)
+    with open(fname, "wb") as f:
+        f.write("# Метеостанция Днепропетровск, Украина, WMO_ID=34504\n"
+                "# Кодировка: UTF-8\n"
+                "#\n"
+                '"Местное время в Днепропетровске";"T";"Po";"P";"Pa";"U";"DD";"Ff";"ff10";"ff3";"N";\n'
+                .encode("utf-8"))
+        while date >= start:
+            press = 740+rnd.random()*20
+            line = ('"%s";"%.1f";"%.1f";"%.1f";"0.1";"%d";"Ветер, дующий с юга";"%d";"";"";"90%%";\n'
+                    % (date.strftime("%d.%m.%Y %H:%M"), rnd.random()*30-10,
+                       press, press+10, rnd.randint(40, 100), rnd.randint(0, 8)))
+            f.write(line.encode("utf-8"))
+            date -= datetime.timedelta(hours=3)
+
+def pogoda_months():
+    """
+    Месяцы, для которых есть локальные архивы pogoda.by
+    """
+    dates = []
+    for fname in sorted(glob.glob(os.path.join(HERE, "pogoda.by", "*_*.zip"))):
+        year, month = os.path.basename(fname)[:-len(".zip")].split("_")
+        dates.append(datetime.datetime(int(year), int(month), 1))
+    return dates
+
+def loaded_pogoda():
+    md = MeteoData.PogodaBy()
+    for date in pogoda_months():
+        md.parse(date)
+    return md
+
+def measure(fnct, setup=None, repeat=5):
+    """
+    Выполняет fnct(*setup()) repeat раз, возвращает лучшее и среднее время
+    """
+    times = []
+    for i in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.time()
+        fnct(*args)
+        times.append(time.time()-start)
+    return {"best": min(times), "mean": sum(times)/len(times), "repeat": repeat}
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+import MeteoData
+elapsed = time.time() - start
+heavy = [name for name in ("matplotlib", "numpy", "pylab") if name in sys.modules]
+print("%r %s" % (elapsed, ",".join(heavy)))
+"""
+
+def measure_import(repeat=5):
+    """
+    Время импорта MeteoData в новом процессе (лучшее и среднее)
+    и список тяжелых модулей, импортированных вместе с ним
+    """
+    times = []
+    heavy = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT], cwd=HERE)
+        fields = out.decode("ascii").split()
+        times.append(float(fields[0]))
+        if len(fields) > 1:
+            heavy = fields[1].split(",")
+    return {"best": min(times), "mean": sum(times)/len(times), "repeat": repeat,
+            "heavy": heavy}
+
+def benchmarks(workdir, rp5_years):
+    """
+    Возвращает список замеров (имя, функция, подготовка)
+    """
+    pages = []
+    for fname in sorted(glob.glob(os.path.join(FIXTURES, "meteoprog_*.html"))):
+        with open(fname, "rb") as f:
+            pages.append(f.read())
+
+    def parse_pages(mp, parse):
+        for html in pages:
+            parse(mp, html)
+
+    # SoupStrainer для archive_table проверяется на каждом теге страницы:
+    # при разборе с parse_only - по имени и атрибутам, при поиске - по тегу
+    soup = BeautifulSoup(pages[0], "html.parser")
+    tags = [tag for tag in soup.descendants if isinstance(tag, Tag)]
+    start_tags = [(tag.name, dict(tag.attrs)) for tag in tags]
+
+    def strainer_search(strainer):
+        for tag in tags:
+            strainer.search_tag(tag)
+        for name, attrs in start_tags:
+            strainer.search_tag(name, attrs)
+
+    # CSS-селекторы: по всей странице и по каждой строке таблицы архива
+    rows = soup.select("table.archive_table tr")
+
+    def select(soup):
+        soup.select("div#content table.archive_table > tr > td")
+        soup.select("tr + tr")
+        for row in rows:
+            row.select("td:nth-of-type(2)")
+
+    rp5_csv = os.path.join(workdir, "data.csv")
+    make_rp5_csv(rp5_csv, rp5_years)
+    rp5_months = MeteoData.months(datetime.datetime(2010, 1, 1),
+                                  datetime.datetime(2010+rp5_years-1, 12, 1))
+
+    def new_rp5(index=True):
+        if not index and os.path.exists(rp5_csv+".idx"):
+            os.remove(rp5_csv+".idx")
+        md = MeteoData.MeteoRP5(rp5_csv, MeteoData.GapFiller(sources=()))
+        if index:
+            md.month_index()
+        return md
+
+    def parse_rp5(md):
+        for date in rp5_months:
+            md.parse(date)
+
+    def parse_pogoda(md):
+        for date in pogoda_months():
+            md.parse(date)
+
+    # load_range загружает недостающие месяцы, поэтому берем
+    # самый длинный непрерывный интервал локальных архивов
+    dates = []
+    run = []
+    for date in pogoda_months():
+        if run and MeteoData.months(run[-1], date)[1:] != [date]:
+            run = []
+        run.append(date)
+        if len(run) > len(dates):
+            dates = list(run)
+    station = loaded_pogoda()
+    stamps = station.get_date_month()
+    days = sorted(set(datetime.datetime(d.year, d.month, d.day) for d in stamps))
+    rnd = random.Random(1)
+    lookups = [rnd.choice(stamps) for i in range(10000)]
+
+    def get(md):
+        for date in lookups:
+            md.get(date, "temperature")
+
+    def get_list(md):
+        for day in days:
+            md.get_list(day, "temperature")
+
+    def aggregates(md):
+        for day in days:
+            md.get_temp(day)
+            md.get_presure(day)
+            md.get_avr_param(day, "local presure")
+        md.get_extremum_field("temperature")
+        md.get_extremum_field("temperature", min)
+
+    return [
+        ("MeteoProg.parse_html", lambda mp: parse_pages(mp, MeteoData.MeteoProg.parse_html),
+         lambda: (MeteoData.MeteoProg(cache=False),)),
+        ("MeteoProg.parse_soup", lambda mp: parse_pages(mp, MeteoData.MeteoProg.parse_soup),
+         lambda: (MeteoData.MeteoProg(cache=False),)),
+        ("SoupStrainer.search_tag", strainer_search,
+         lambda: (SoupStrainer("table", {"class": "archive_table"}),)),
+        ("Tag.select", select, lambda: (soup,)),
+        ("MeteoRP5.month_index", lambda md: md.month_index(), lambda: (new_rp5(index=False),)),
+        ("MeteoRP5.parse", parse_rp5, lambda: (new_rp5(),)),
+        ("PogodaBy.parse", parse_pogoda, lambda: (MeteoData.PogodaBy(),)),
+        ("PogodaBy.load_range", lambda md: md.load_range(dates[0], dates[-1]),
+         lambda: (MeteoData.PogodaBy(),)),
+        ("MeteoStation.save", lambda md: md.save(os.path.join(workdir, "save.csv")),
+         lambda: (station,)),
+        ("MeteoStation.parse_file",
+         lambda mp: mp.parse_file(os.path.join(HERE, "meteoprog.ua", "meteoprog.csv")),
+         lambda: (MeteoData.MeteoProg(cache=False),)),
+        ("MeteoStation.get", get, lambda: (station,)),
+        ("MeteoStation.get_list", get_list, lambda: (station,)),
+        ("MeteoStation.aggregates", aggregates, lambda: (station,)),
+    ]
+
+def run(repeat=5, rp5_years=4):
+    workdir = tempfile.mkdtemp()
+    try:
+        results = {"import MeteoData": measure_import(repeat)}
+        print "%-28s %.4fs" % ("import MeteoData", results["import MeteoData"]["best"])
+        for name, fnct, setup in benchmarks(workdir, rp5_years):
+            results[name] = measure(fnct, setup, repeat)
+            print "%-28s %.4fs" % (name, results[name]["best"])
+    finally:
+        shutil.rmtree(workdir)
+    return {"python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "date": datetime.datetime.now().isoformat(),
+            "repeat": repeat,
+            "rp5_years": rp5_years,
+            "results": results}
+
+def compare(report, baseline, threshold=1.2):
+    """
+    Сравнивает лучшие времена с baseline, возвращает список регрессий
+    """
+    regressions = []
+    print
+    print "%-28s %10s %10s %7s" % ("benchmark", "baseline", "current", "ratio")
+    for name in sorted(report["results"]):
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]["best"]
+        new = report["results"][name]["best"]
+        ratio = new/old if old else float("inf")
+        mark = ""
+        if ratio > threshold:
+            mark = " REGRESSION"
+            regressions.append(name)
+        print "%-28s %9.4fs %9.4fs %6.2fx%s" % (name, old, new, ratio, mark)
+    return regressions
+
+def check_import(report, budget):
+    """
+    Проверяет бюджет времени импорта, возвращает True, если он соблюден
+    """
+    result = report["results"]["import MeteoData"]
+    ok = result["best"] <= budget and not result["heavy"]
+    print
+    print "import MeteoData: %.4fs (budget %.4fs)%s%s" % (
+        result["best"], budget,
+        ", imports " + ", ".join(result["heavy"]) if result["heavy"] else "",
+        "" if ok else " OVER BUDGET")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="MeteoData benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rp5-years", type=int, default=4,
+                        help="size of the generated rp5 data.csv in years")
+    parser.add_argument("--output", default=os.path.join(FIXTURES, "results.json"))
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio reported as a regression")
+    parser.add_argument("--import-budget", type=float, default=0.5,
+                        help="max seconds to import MeteoData without plotting")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        # читаем заранее - output может совпадать с baseline
+        with open(args.baseline, "rb") as f:
+            baseline = json.load(f)
+    report = run(args.repeat, args.rp5_years)
+    with open(args.output, "wb") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results saved to", args.output
+    failed = not check_import(report, args.import_budget)
+    if baseline is not None:
+        if compare(report, baseline, args.threshold):
+            failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -35,12 +35,14 @@ from .element import (
     DEFAULT_OUTPUT_ENCODING,
     Declaration,
     Doctype,
+    EMPTY_CONTENTS,
     NavigableString,
     PageElement,
     ProcessingInstruction,
     ResultSet,
     SoupStrainer,
     Tag,
+    TagIndex,
     )
 
 # The very first thing we do is give a useful error if someone is
@@ -77,11 +79,25 @@ class BeautifulSoup(Tag):
 
     ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
 
+    read_only = False
+
     def __init__(self, markup="", features=None, builder=None,
-                 parse_only=None, from_encoding=None, **kwargs):
+                 parse_only=None, from_encoding=None, read_only=False,
+                 build_index=False, **kwargs):
         """The Soup object is initialized as the 'root tag', and the
         provided markup (which can be a string or a file-like object)
-        is fed into the underlying parser."""
+        is fed into the underlying parser.
+
+        If read_only is true, the tree is built for searching rather
+        than editing: tags without attributes or children share empty
+        sentinels instead of allocating their own dict and list, and
+        the charset in a META tag is not rewritten on output.
+
+        If build_index is true, a TagIndex of tag names, ids and
+        classes is built along with the tree, and find_all() calls
+        that search for any of them are answered from the index
+        instead of walking the tree.
+        """
 
         if 'convertEntities' in kwargs:
             warnings.warn(
@@ -156,6 +172,8 @@ class BeautifulSoup(Tag):
         self.builder.soup = self
 
         self.parse_only = parse_only
+        self.read_only = read_only
+        self.build_index = build_index
 
         if hasattr(markup, 'read'):        # It's a file-type object.
             markup = markup.read()
@@ -221,8 +239,16 @@ class BeautifulSoup(Tag):
         self.currentTag = None
         self.tagStack = []
         self.preserve_whitespace_tag_stack = []
+        if self.build_index:
+            self.tag_index = TagIndex()
         self.pushTag(self)
 
+    def reindex(self):
+        """Rebuild the tag index on the next query. Call this after
+        changing a tag's name or attrs directly."""
+        if self.tag_index is not None:
+            self.tag_index.stale = True
+
     def new_tag(self, name, namespace=None, nsprefix=None, **attrs):
         """Create a new tag associated with this soup."""
         return Tag(None, self.builder, name, namespace, nsprefix, attrs)
@@ -251,9 +277,13 @@ class BeautifulSoup(Tag):
     def pushTag(self, tag):
         #print "Push", tag.name
         if self.currentTag:
+            if self.currentTag.contents is EMPTY_CONTENTS:
+                self.currentTag.contents = []
             self.currentTag.contents.append(tag)
         self.tagStack.append(tag)
         self.currentTag = self.tagStack[-1]
+        if self.tag_index is not None and tag is not self:
+            self.tag_index.add(tag)
         if tag.name in self.builder.preserve_whitespace_tags:
             self.preserve_whitespace_tag_stack.append(tag)
 
@@ -292,10 +322,16 @@ class BeautifulSoup(Tag):
         parent = parent or self.currentTag
         most_recent_element = most_recent_element or self._most_recent_element
         o.setup(parent, most_recent_element)
+        if self.tag_index is not None and isinstance(o, Tag):
+            # Tags that show up here (from html5lib) may not arrive in
+            # document order. Index them on the first query.
+            self.tag_index.stale = True
 
         if most_recent_element is not None:
             most_recent_element.next_element = o
         self._most_recent_element = o
+        if parent.contents is EMPTY_CONTENTS:
+            parent.contents = []
         parent.contents.append(o)
 
     def _popToTag(self, name, nsprefix=None, inclusivePop=True):
@@ -6,6 +6,7 @@ import bs4
 from bs4 import BeautifulSoup, __version__
 from bs4.builder import builder_registry
 
+import gc
 import os
 import pstats
 import random
@@ -200,5 +201,39 @@ def profile(num_elements=100000, parser="lxml"):
     stats.sort_stats("cumulative")
     stats.print_stats('_html5lib|bs4', 50)
 
+def node_stats(data, parser="html.parser", repeat=5, **kwargs):
+    """Measure parse time and the memory held by each tree node.
+
+    Only the node object itself and its instance __dict__ (if one was
+    ever created) are counted per node; the attribute dictionaries and
+    contents lists of the tags are counted separately, once each, since
+    a read-only parse shares the empty ones. Extra keyword arguments
+    are passed to the BeautifulSoup constructor.
+    """
+    times = []
+    for i in range(repeat):
+        a = time.time()
+        soup = BeautifulSoup(data, parser, **kwargs)
+        times.append(time.time() - a)
+    nodes = [soup] + list(soup.descendants)
+    total = 0
+    containers = {}
+    for node in nodes:
+        total += sys.getsizeof(node)
+        attrs = getattr(node, 'attrs', None)
+        for referent in gc.get_referents(node):
+            if type(referent) is dict and referent is not attrs:
+                total += sys.getsizeof(referent)
+        if isinstance(node, bs4.Tag):
+            containers[id(node.attrs)] = node.attrs
+            containers[id(node.contents)] = node.contents
+    container_size = sum(sys.getsizeof(c) for c in containers.values())
+    print "Parsed %d nodes with %s in %.4fs (best of %d)." % (
+        len(nodes), parser, min(times), repeat)
+    print "%.1f bytes per node." % (float(total) / len(nodes))
+    print "%d attribute dicts and contents lists, %d bytes." % (
+        len(containers), container_size)
+    return min(times), float(total) / len(nodes), len(containers)
+
 if __name__ == '__main__':
     diagnose(sys.stdin.read())
@@ -1,6 +1,8 @@
+import bisect
 import collections
 import re
 import sys
+import threading
 import warnings
 from bs4.dammit import EntitySubstitution
 
@@ -116,10 +118,61 @@ class HTMLAwareEntitySubstitution(EntitySubstitution):
         return cls._substitute_if_appropriate(
             ns, EntitySubstitution.substitute_xml)
 
+class ReadOnlyDict(dict):
+    """The empty attribute dictionary shared by the tags of a read-only parse.
+
+    Tag methods that add attributes replace it with a real dictionary
+    first; modifying it directly raises TypeError.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(
+            "This tag was created by a read-only parse and shares its "
+            "empty attribute dictionary. Use tag[key] = value instead.")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+    def __reduce__(self):
+        return 'EMPTY_ATTRIBUTES'
+
+class ReadOnlyList(list):
+    """The empty contents list shared by the tags of a read-only parse.
+
+    Tag methods that add children replace it with a real list first;
+    modifying it directly raises TypeError.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(
+            "This tag was created by a read-only parse and shares its "
+            "empty contents list. Use tag.append() instead.")
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = \
+        __imul__ = append = extend = insert = pop = remove = reverse = \
+        sort = _read_only
+
+    def __reduce__(self):
+        return 'EMPTY_CONTENTS'
+
+EMPTY_ATTRIBUTES = ReadOnlyDict()
+EMPTY_CONTENTS = ReadOnlyList()
+
+# Every node keeps its links to the rest of the tree in slots rather
+# than in a per-instance __dict__. A __dict__ slot is still provided,
+# so arbitrary attributes can be set on a node, but the dictionary is
+# only allocated when that actually happens.
+NAVIGATION_SLOTS = ('parent', 'previous_element', 'next_element',
+                    'previous_sibling', 'next_sibling')
+
 class PageElement(object):
     """Contains the navigational information for some part of the page
     (either a tag or a piece of text)"""
 
+    __slots__ = ()
+
+    # The TagIndex of the document. Only a BeautifulSoup object built
+    # with build_index=True has one.
+    tag_index = None
+
     # There are five possible values for the "formatter" argument passed in
     # to methods like encode() and prettify():
     #
@@ -185,6 +238,35 @@ class PageElement(object):
             return self.HTML_FORMATTERS.get(
                 name, HTMLAwareEntitySubstitution.substitute_xml)
 
+    def _slot_state(self):
+        "Yield (name, value) for every slot that has been set."
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name in ('__dict__', '__weakref__'):
+                    continue
+                try:
+                    yield name, cls.__dict__[name].__get__(self, cls)
+                except AttributeError:
+                    pass
+
+    def __getstate__(self):
+        state = dict(self._slot_state())
+        state.update(self.__dict__)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def _tree_changed(self):
+        """Mark the tag index of this element's document, if any, as
+        stale. The index is rebuilt the next time it's needed."""
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        if root.tag_index is not None:
+            root.tag_index.stale = True
+
     def setup(self, parent=None, previous_element=None):
         """Sets up the initial relations between this element and
         other elements."""
@@ -231,6 +313,7 @@ class PageElement(object):
 
     def extract(self):
         """Destructively rips this element out of the tree."""
+        self._tree_changed()
         if self.parent is not None:
             del self.parent.contents[self.parent.index(self)]
 
@@ -272,6 +355,8 @@ class PageElement(object):
     def insert(self, position, new_child):
         if new_child is self:
             raise ValueError("Cannot insert a tag into itself.")
+        if self.contents is EMPTY_CONTENTS:
+            self.contents = []
         if (isinstance(new_child, basestring)
             and not isinstance(new_child, NavigableString)):
             new_child = NavigableString(new_child)
@@ -332,6 +417,7 @@ class PageElement(object):
         if new_childs_last_element.next_element is not None:
             new_childs_last_element.next_element.previous_element = new_childs_last_element
         self.contents.insert(position, new_child)
+        self._tree_changed()
 
     def append(self, tag):
         """Appends the given tag to the contents of this tag."""
@@ -581,7 +667,8 @@ class PageElement(object):
                 return tag.name == tag_name and function(tag)
             return _match
 
-    def _attribute_checker(self, operator, attribute, value=''):
+    @staticmethod
+    def _attribute_checker(operator, attribute, value=''):
         """Create a function that performs a CSS selector operation.
 
         Takes an operator, attribute and optional value. Returns a
@@ -642,6 +729,8 @@ class PageElement(object):
 
 class NavigableString(unicode, PageElement):
 
+    __slots__ = NAVIGATION_SLOTS + ('__dict__', '__weakref__')
+
     PREFIX = ''
     SUFFIX = ''
 
@@ -742,22 +831,38 @@ class Tag(PageElement):
 
     """Represents a found HTML tag with its attributes and contents."""
 
+    __slots__ = NAVIGATION_SLOTS + (
+        'parser_class', 'name', 'namespace', 'prefix', 'attrs', 'contents',
+        'hidden', 'can_be_empty_element', '_position', '__dict__',
+        '__weakref__')
+
     def __init__(self, parser=None, builder=None, name=None, namespace=None,
                  prefix=None, attrs=None, parent=None, previous=None):
-        "Basic constructor."
+        """Basic constructor.
 
+        If the parser is doing a read-only parse, a tag without
+        attributes or contents shares the EMPTY_ATTRIBUTES and
+        EMPTY_CONTENTS sentinels until it is modified, and no
+        substitutions (such as the charset in a META tag) are set up.
+        """
+        read_only = False
         if parser is None:
             self.parser_class = None
         else:
             # We don't actually store the parser object: that lets extracted
             # chunks be garbage-collected.
             self.parser_class = parser.__class__
+            read_only = getattr(parser, 'read_only', False)
         if name is None:
             raise ValueError("No value provided for new tag's name.")
+        # The position of this tag in the document's TagIndex.
+        self._position = None
         self.name = name
         self.namespace = namespace
         self.prefix = prefix
-        if attrs is None:
+        if not attrs and read_only:
+            attrs = EMPTY_ATTRIBUTES
+        elif attrs is None:
             attrs = {}
         elif attrs and builder.cdata_list_attributes:
             attrs = builder._replace_cdata_list_attribute_values(
@@ -765,13 +870,17 @@ class Tag(PageElement):
         else:
             attrs = dict(attrs)
         self.attrs = attrs
-        self.contents = []
+        if read_only:
+            self.contents = EMPTY_CONTENTS
+        else:
+            self.contents = []
         self.setup(parent, previous)
         self.hidden = False
 
-        # Set up any substitutions, such as the charset in a META tag.
         if builder is not None:
-            builder.set_up_substitutions(self)
+            if not read_only:
+                # Set up any substitutions, such as the charset in a META tag.
+                builder.set_up_substitutions(self)
             self.can_be_empty_element = builder.can_be_empty_element(name)
         else:
             self.can_be_empty_element = False
@@ -859,6 +968,8 @@ class Tag(PageElement):
         i = self
         while i is not None:
             next = i.next_element
+            for name, value in list(i._slot_state()):
+                delattr(i, name)
             i.__dict__.clear()
             i.contents = []
             i = next
@@ -922,11 +1033,17 @@ class Tag(PageElement):
     def __setitem__(self, key, value):
         """Setting tag[key] sets the value of the 'key' attribute for the
         tag."""
+        if self.attrs is EMPTY_ATTRIBUTES:
+            self.attrs = {}
         self.attrs[key] = value
+        self._tree_changed()
 
     def __delitem__(self, key):
         "Deleting tag[key] deletes all 'key' attributes for the tag."
+        if self.attrs is EMPTY_ATTRIBUTES:
+            return
         self.attrs.pop(key, None)
+        self._tree_changed()
 
     def __call__(self, *args, **kwargs):
         """Calling a tag like a function is the same as calling its
@@ -1174,6 +1291,10 @@ class Tag(PageElement):
         string matches for some custom definition of 'matches'. The
         same is true of the tag name."""
 
+        if recursive and text is None:
+            found = self._find_all_indexed(name, attrs, limit, kwargs)
+            if found is not None:
+                return found
         generator = self.descendants
         if not recursive:
             generator = self.children
@@ -1181,6 +1302,61 @@ class Tag(PageElement):
     findAll = find_all       # BS3
     findChildren = find_all  # BS2
 
+    def _find_all_indexed(self, name, attrs, limit, kwargs):
+        """Answer a find_all() query from the document's TagIndex.
+
+        Returns None if the document has no index or the index can't
+        narrow down the query.
+        """
+        if not self.contents:
+            # Nothing to search (this also covers decomposed tags,
+            # which have no parent to look up).
+            return None
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        index = root.tag_index
+        if index is None:
+            return None
+        if index.stale:
+            index.rebuild(root)
+
+        if isinstance(name, SoupStrainer):
+            strainer = name
+        else:
+            strainer = SoupStrainer(name, attrs, None, **kwargs)
+        if strainer.text is not None:
+            return None
+
+        # The tags of this subtree occupy the positions between this
+        # tag and the first tag after its last descendant.
+        if self is root:
+            start, end = 0, None
+        else:
+            start = self._position + 1
+            following = self._last_descendant().next_element
+            while following is not None and not isinstance(following, Tag):
+                following = following.next_element
+            if following is None:
+                end = None
+            else:
+                end = following._position
+        candidates = index.candidates(strainer, start, end)
+        if candidates is None:
+            return None
+        tags, exact = candidates
+        if exact:
+            if limit:
+                tags = tags[:limit]
+            return ResultSet(strainer, tags)
+        results = ResultSet(strainer)
+        for tag in tags:
+            if strainer.search_tag(tag):
+                results.append(tag)
+                if limit and len(results) >= limit:
+                    break
+        return results
+
     #Generator methods
     @property
     def children(self):
@@ -1201,202 +1377,22 @@ class Tag(PageElement):
 
     _selector_combinators = ['>', '+', '~']
     _select_debug = False
-    def select(self, selector, _candidate_generator=None):
-        """Perform a CSS selection operation on the current element."""
-        tokens = selector.split()
-        current_context = [self]
+    def select(self, selector):
+        """Perform a CSS selection operation on the current element.
 
-        if tokens[-1] in self._selector_combinators:
-            raise ValueError(
-                'Final combinator "%s" is missing an argument.' % tokens[-1])
+        The selector is compiled once and kept in CSSSelector's cache,
+        so running the same selector again skips the parsing.
+        Matching tags are returned in document order.
+        """
+        compiled = CSSSelector.compile(selector)
         if self._select_debug:
             print 'Running CSS selector "%s"' % selector
-        for index, token in enumerate(tokens):
-            if self._select_debug:
-                print ' Considering token "%s"' % token
-            recursive_candidate_generator = None
-            tag_name = None
-            if tokens[index-1] in self._selector_combinators:
-                # This token was consumed by the previous combinator. Skip it.
-                if self._select_debug:
-                    print '  Token was consumed by the previous combinator.'
-                continue
-            # Each operation corresponds to a checker function, a rule
-            # for determining whether a candidate matches the
-            # selector. Candidates are generated by the active
-            # iterator.
-            checker = None
-
-            m = self.attribselect_re.match(token)
-            if m is not None:
-                # Attribute selector
-                tag_name, attribute, operator, value = m.groups()
-                checker = self._attribute_checker(operator, attribute, value)
-
-            elif '#' in token:
-                # ID selector
-                tag_name, tag_id = token.split('#', 1)
-                def id_matches(tag):
-                    return tag.get('id', None) == tag_id
-                checker = id_matches
-
-            elif '.' in token:
-                # Class selector
-                tag_name, klass = token.split('.', 1)
-                classes = set(klass.split('.'))
-                def classes_match(candidate):
-                    return classes.issubset(candidate.get('class', []))
-                checker = classes_match
-
-            elif ':' in token:
-                # Pseudo-class
-                tag_name, pseudo = token.split(':', 1)
-                if tag_name == '':
-                    raise ValueError(
-                        "A pseudo-class must be prefixed with a tag name.")
-                pseudo_attributes = re.match('([a-zA-Z\d-]+)\(([a-zA-Z\d]+)\)', pseudo)
-                found = []
-                if pseudo_attributes is not None:
-                    pseudo_type, pseudo_value = pseudo_attributes.groups()
-                    if pseudo_type == 'nth-of-type':
-                        try:
-                            pseudo_value = int(pseudo_value)
-                        except:
-                            raise NotImplementedError(
-                                'Only numeric values are currently supported for the nth-of-type pseudo-class.')
-                        if pseudo_value < 1:
-                            raise ValueError(
-                                'nth-of-type pseudo-class value must be at least 1.')
-                        class Counter(object):
-                            def __init__(self, destination):
-                                self.count = 0
-                                self.destination = destination
-
-                            def nth_child_of_type(self, tag):
-                                self.count += 1
-                                if self.count == self.destination:
-                                    return True
-                                if self.count > self.destination:
-                                    # Stop the generator that's sending us
-                                    # these things.
-                                    raise StopIteration()
-                                return False
-                        checker = Counter(pseudo_value).nth_child_of_type
-                    else:
-                        raise NotImplementedError(
-                            'Only the following pseudo-classes are implemented: nth-of-type.')
-
-            elif token == '*':
-                # Star selector -- matches everything
-                pass
-            elif token == '>':
-                # Run the next token as a CSS selector against the
-                # direct children of each tag in the current context.
-                recursive_candidate_generator = lambda tag: tag.children
-            elif token == '~':
-                # Run the next token as a CSS selector against the
-                # siblings of each tag in the current context.
-                recursive_candidate_generator = lambda tag: tag.next_siblings
-            elif token == '+':
-                # For each tag in the current context, run the next
-                # token as a CSS selector against the tag's next
-                # sibling that's a tag.
-                def next_tag_sibling(tag):
-                    yield tag.find_next_sibling(True)
-                recursive_candidate_generator = next_tag_sibling
-
-            elif self.tag_name_re.match(token):
-                # Just a tag name.
-                tag_name = token
-            else:
-                raise ValueError(
-                    'Unsupported or invalid CSS selector: "%s"' % token)
-
-            if recursive_candidate_generator:
-                # This happens when the selector looks like  "> foo".
-                #
-                # The generator calls select() recursively on every
-                # member of the current context, passing in a different
-                # candidate generator and a different selector.
-                #
-                # In the case of "> foo", the candidate generator is
-                # one that yields a tag's direct children (">"), and
-                # the selector is "foo".
-                next_token = tokens[index+1]
-                def recursive_select(tag):
-                    if self._select_debug:
-                        print '    Calling select("%s") recursively on %s %s' % (next_token, tag.name, tag.attrs)
-                        print '-' * 40
-                    for i in tag.select(next_token, recursive_candidate_generator):
-                        if self._select_debug:
-                            print '(Recursive select picked up candidate %s %s)' % (i.name, i.attrs)
-                        yield i
-                    if self._select_debug:
-                        print '-' * 40
-                _use_candidate_generator = recursive_select
-            elif _candidate_generator is None:
-                # By default, a tag's candidates are all of its
-                # children. If tag_name is defined, only yield tags
-                # with that name.
-                if self._select_debug:
-                    if tag_name:
-                        check = "[any]"
-                    else:
-                        check = tag_name
-                    print '   Default candidate generator, tag name="%s"' % check
-                if self._select_debug:
-                    # This is redundant with later code, but it stops
-                    # a bunch of bogus tags from cluttering up the
-                    # debug log.
-                    def default_candidate_generator(tag):
-                        for child in tag.descendants:
-                            if not isinstance(child, Tag):
-                                continue
-                            if tag_name and not child.name == tag_name:
-                                continue
-                            yield child
-                    _use_candidate_generator = default_candidate_generator
-                else:
-                    _use_candidate_generator = lambda tag: tag.descendants
-            else:
-                _use_candidate_generator = _candidate_generator
-
-            new_context = []
-            new_context_ids = set([])
-            for tag in current_context:
-                if self._select_debug:
-                    print "    Running candidate generator on %s %s" % (
-                        tag.name, repr(tag.attrs))
-                for candidate in _use_candidate_generator(tag):
-                    if not isinstance(candidate, Tag):
-                        continue
-                    if tag_name and candidate.name != tag_name:
-                        continue
-                    if checker is not None:
-                        try:
-                            result = checker(candidate)
-                        except StopIteration:
-                            # The checker has decided we should no longer
-                            # run the generator.
-                            break
-                    if checker is None or result:
-                        if self._select_debug:
-                            print "     SUCCESS %s %s" % (candidate.name, repr(candidate.attrs))
-                        if id(candidate) not in new_context_ids:
-                            # If a tag matches a selector more than once,
-                            # don't include it in the context more than once.
-                            new_context.append(candidate)
-                            new_context_ids.add(id(candidate))
-                    elif self._select_debug:
-                        print "     FAILURE %s %s" % (candidate.name, repr(candidate.attrs))
-
-            current_context = new_context
-
+        found = compiled.select(self)
         if self._select_debug:
             print "Final verdict:"
-            for i in current_context:
+            for i in found:
                 print " %s %s" % (i.name, i.attrs)
-        return current_context
+        return found
 
     # Old names for backwards compatibility
     def childGenerator(self):
@@ -1413,6 +1409,209 @@ class Tag(PageElement):
                 key))
         return self.has_attr(key)
 
+class CSSSelector(object):
+    """A CSS selector compiled into a matching plan.
+
+    The selector is split into steps: compound selectors (a tag name
+    plus at most one id, class, attribute or pseudo-class test), each
+    with the combinator that joins it to the step before. select()
+    walks the tree once in document order, passing down which steps
+    have matched so far among a tag's ancestors and previous siblings,
+    so every combinator is checked without going back up the tree.
+
+    compile() keeps the most recently used selectors in an LRU cache.
+    """
+
+    combinators = Tag._selector_combinators
+
+    # The number of compiled selectors to keep.
+    cache_size = 256
+    _cache = collections.OrderedDict()
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def compile(cls, selector):
+        """Compile a selector, or get the compiled one from the cache."""
+        with cls._cache_lock:
+            compiled = cls._cache.pop(selector, None)
+            if compiled is not None:
+                cls._cache[selector] = compiled
+                return compiled
+        compiled = cls(selector)
+        with cls._cache_lock:
+            cls._cache[selector] = compiled
+            while len(cls._cache) > cls.cache_size:
+                cls._cache.popitem(last=False)
+        return compiled
+
+    def __init__(self, selector):
+        self.selector = selector
+        tokens = selector.split()
+        if tokens[-1] in self.combinators:
+            raise ValueError(
+                'Final combinator "%s" is missing an argument.' % tokens[-1])
+        self.steps = []
+        combinator = ' '
+        for token in tokens:
+            if token in self.combinators:
+                if combinator != ' ':
+                    raise ValueError(
+                        'Combinator "%s" is missing an argument.' % combinator)
+                combinator = token
+                continue
+            tag_name, checker = self._compile_token(token)
+            self.steps.append((combinator, tag_name, checker))
+            combinator = ' '
+
+        # Bit i+1 of a tag's state is set when steps 0..i match,
+        # ending at that tag. Bit 0 stands for the scope itself.
+        self.final = 1 << len(self.steps)
+        plan = [(tag_name, (combinator, checker, 1 << i, 1 << (i + 1)))
+                for i, (combinator, tag_name, checker)
+                in enumerate(self.steps)]
+        # The steps to try on a tag, looked up by its name.
+        self.any_name = tuple(entry for tag_name, entry in plan
+                              if tag_name is None)
+        self.by_name = {}
+        for tag_name, entry in plan:
+            if tag_name is not None:
+                self.by_name.setdefault(tag_name, self.any_name)
+                self.by_name[tag_name] += (entry,)
+
+    def _compile_token(self, token):
+        """Turn one compound selector into (tag name, checker)."""
+        tag_name = None
+        checker = None
+
+        m = PageElement.attribselect_re.match(token)
+        if m is not None:
+            # Attribute selector
+            tag_name, attribute, operator, value = m.groups()
+            checker = PageElement._attribute_checker(operator, attribute, value)
+
+        elif '#' in token:
+            # ID selector
+            tag_name, tag_id = token.split('#', 1)
+            def id_matches(tag):
+                return tag.attrs.get('id', None) == tag_id
+            checker = id_matches
+
+        elif '.' in token:
+            # Class selector
+            tag_name, klass = token.split('.', 1)
+            classes = set(klass.split('.'))
+            def classes_match(candidate):
+                return classes.issubset(candidate.attrs.get('class', []))
+            checker = classes_match
+
+        elif ':' in token:
+            # Pseudo-class
+            tag_name, pseudo = token.split(':', 1)
+            if tag_name == '':
+                raise ValueError(
+                    "A pseudo-class must be prefixed with a tag name.")
+            pseudo_attributes = re.match('([a-zA-Z\d-]+)\(([a-zA-Z\d]+)\)', pseudo)
+            if pseudo_attributes is not None:
+                pseudo_type, pseudo_value = pseudo_attributes.groups()
+                if pseudo_type == 'nth-of-type':
+                    try:
+                        pseudo_value = int(pseudo_value)
+                    except:
+                        raise NotImplementedError(
+                            'Only numeric values are currently supported for the nth-of-type pseudo-class.')
+                    if pseudo_value < 1:
+                        raise ValueError(
+                            'nth-of-type pseudo-class value must be at least 1.')
+                    def nth_of_type(tag, destination=pseudo_value):
+                        # Is this the destination'th child of its
+                        # parent with this tag name?
+                        count = 1
+                        for sibling in tag.previous_siblings:
+                            if isinstance(sibling, Tag) and sibling.name == tag.name:
+                                count += 1
+                                if count > destination:
+                                    return False
+                        return count == destination
+                    checker = nth_of_type
+                else:
+                    raise NotImplementedError(
+                        'Only the following pseudo-classes are implemented: nth-of-type.')
+
+        elif token == '*':
+            # Star selector -- matches everything
+            pass
+
+        elif PageElement.tag_name_re.match(token):
+            # Just a tag name.
+            tag_name = token
+        else:
+            raise ValueError(
+                'Unsupported or invalid CSS selector: "%s"' % token)
+        return tag_name or None, checker
+
+    def select(self, scope):
+        """Find the tags beneath `scope` that match, in document order."""
+        by_name = self.by_name
+        any_name = self.any_name
+        final = self.final
+        found = []
+        if len(self.steps) == 1 and self.steps[0][0] == ' ':
+            # Nothing to remember about ancestors or siblings.
+            for child in scope.descendants:
+                if not isinstance(child, Tag):
+                    continue
+                for combinator, checker, need, bit in by_name.get(
+                    child.name, any_name):
+                    if checker is None or checker(child):
+                        found.append(child)
+            return found
+        if self.steps[0][0] in ('+', '~'):
+            # "+ foo" and "~ foo" look at the scope's own siblings.
+            children = scope.next_siblings
+            inherited = parent_states = 0
+            previous = earlier = 1
+        else:
+            children = iter(scope.contents)
+            inherited = parent_states = 1
+            previous = earlier = 0
+        stack = []
+        while True:
+            for child in children:
+                if not isinstance(child, Tag):
+                    continue
+                states = 0
+                for combinator, checker, need, bit in by_name.get(
+                    child.name, any_name):
+                    if combinator == ' ':
+                        have = inherited
+                    elif combinator == '>':
+                        have = parent_states
+                    elif combinator == '+':
+                        have = previous
+                    else:
+                        have = earlier
+                    if have & need and (checker is None or checker(child)):
+                        states |= bit
+                if states & final:
+                    found.append(child)
+                previous = states
+                earlier |= states
+                if child.contents:
+                    # Go down into the child; come back to its next
+                    # sibling when its contents run out.
+                    stack.append(
+                        (children, inherited, parent_states, previous, earlier))
+                    children = iter(child.contents)
+                    inherited |= states
+                    parent_states = states
+                    previous = earlier = 0
+                    break
+            else:
+                if not stack:
+                    return found
+                children, inherited, parent_states, previous, earlier = stack.pop()
+
+
 # Next, a couple classes to represent queries and their results.
 class SoupStrainer(object):
     """Encapsulates a number of ways of matching a markup element (tag or
@@ -1444,6 +1643,95 @@ class SoupStrainer(object):
 
         self.attrs = normalized_attrs
         self.text = self._normalize_search_value(text)
+        self._match_attrs = None
+
+    def _compile_criteria(self):
+        """Compile the criteria into matcher functions, so search_tag()
+        doesn't have to work out what kind of criterion it's looking at
+        for every element and attribute.
+
+        This happens on the first search rather than in the
+        constructor: find_all() creates a strainer for every call, but
+        often answers the query without ever searching with it.
+        """
+        self._name_is_callable = isinstance(
+            self.name, collections.Callable)
+        if self.name:
+            self._match_name = self._compile(self.name)
+        else:
+            self._match_name = None
+        self._match_text = self._compile(self.text)
+        self._match_attrs = [
+            (attr, self._compile(match_against))
+            for attr, match_against in self.attrs.items()]
+
+    def __getstate__(self):
+        # Compiled matchers are closures; they're rebuilt on demand.
+        state = self.__dict__.copy()
+        for key in ('_name_is_callable', '_match_name', '_match_text'):
+            state.pop(key, None)
+        state['_match_attrs'] = None
+        return state
+
+    def _compile(self, match_against):
+        """Turn a normalized criterion into a function that takes
+        markup and does what _matches(markup, match_against) does."""
+        normalize = self._normalize_search_value
+
+        if match_against is True:
+            def match_value(markup):
+                return markup is not None
+        elif isinstance(match_against, collections.Callable):
+            match_value = match_against
+        else:
+            if isinstance(match_against, unicode):
+                # Exact string match
+                def compare(markup):
+                    return markup == match_against
+            elif hasattr(match_against, 'match'):
+                # Regexp match
+                compare = match_against.search
+            elif hasattr(match_against, '__iter__'):
+                # The markup must be an exact match against something
+                # in the iterable.
+                def compare(markup):
+                    return markup in match_against
+            else:
+                # None, False and the like match only missing values.
+                def compare(markup):
+                    return None
+            none_matches = not match_against
+
+            def match_value(markup):
+                # Custom callables take the tag as an argument, but all
+                # other ways of matching match the tag name as a string.
+                if isinstance(markup, Tag):
+                    markup = markup.name
+                if not isinstance(markup, unicode):
+                    markup = normalize(markup)
+                if markup is None:
+                    return none_matches
+                return compare(markup)
+
+        if isinstance(match_against, unicode) and ' ' in match_against:
+            # Matching "foo bar" on a multi-valued attribute only
+            # accepts the literal value "foo bar".
+            split_value = whitespace_re.split(match_against)
+        else:
+            split_value = None
+
+        def match(markup):
+            if isinstance(markup, (list, tuple)):
+                # This should only happen when searching a multi-valued
+                # attribute like 'class'.
+                if split_value is not None:
+                    return split_value == markup
+                for item in markup:
+                    if match(item):
+                        return True
+                return False
+            return match_value(markup)
+        return match
 
     def _normalize_search_value(self, value):
         # Leave it alone if it's a Unicode string, a callable, a
@@ -1482,42 +1770,36 @@ class SoupStrainer(object):
             return "%s|%s" % (self.name, self.attrs)
 
     def search_tag(self, markup_name=None, markup_attrs={}):
+        if self._match_attrs is None:
+            self._compile_criteria()
         found = None
-        markup = None
-        if isinstance(markup_name, Tag):
-            markup = markup_name
-            markup_attrs = markup
+        is_tag = isinstance(markup_name, Tag)
+        if is_tag:
+            markup_attrs = markup_name.attrs
         call_function_with_tag_data = (
-            isinstance(self.name, collections.Callable)
-            and not isinstance(markup_name, Tag))
+            self._name_is_callable and not is_tag)
 
-        if ((not self.name)
+        if ((self._match_name is None)
             or call_function_with_tag_data
-            or (markup and self._matches(markup, self.name))
-            or (not markup and self._matches(markup_name, self.name))):
+            or self._match_name(markup_name)):
             if call_function_with_tag_data:
                 match = self.name(markup_name, markup_attrs)
             else:
                 match = True
-                markup_attr_map = None
-                for attr, match_against in list(self.attrs.items()):
-                    if not markup_attr_map:
-                        if hasattr(markup_attrs, 'get'):
-                            markup_attr_map = markup_attrs
-                        else:
-                            markup_attr_map = {}
-                            for k, v in markup_attrs:
-                                markup_attr_map[k] = v
-                    attr_value = markup_attr_map.get(attr)
-                    if not self._matches(attr_value, match_against):
-                        match = False
-                        break
+                if self._match_attrs:
+                    if not hasattr(markup_attrs, 'get'):
+                        markup_attr_map = {}
+                        for k, v in markup_attrs:
+                            markup_attr_map[k] = v
+                        markup_attrs = markup_attr_map
+                    get = markup_attrs.get
+                    for attr, match_attr in self._match_attrs:
+                        if not match_attr(get(attr)):
+                            match = False
+                            break
             if match:
-                if markup:
-                    found = markup
-                else:
-                    found = markup_name
-        if found and self.text and not self._matches(found.string, self.text):
+                found = markup_name
+        if found and self.text and not self._match_text(found.string):
             found = None
         return found
     searchTag = search_tag
@@ -1541,7 +1823,9 @@ class SoupStrainer(object):
         # If it's text, make sure the text matches.
         elif isinstance(markup, NavigableString) or \
                  isinstance(markup, basestring):
-            if not self.name and not self.attrs and self._matches(markup, self.text):
+            if self._match_attrs is None:
+                self._compile_criteria()
+            if not self.name and not self.attrs and self._match_text(markup):
                 found = markup
         else:
             raise Exception(
@@ -1603,6 +1887,86 @@ class SoupStrainer(object):
             return markup in match_against
 
 
+class TagIndex(object):
+    """Maps tag names, ids and classes to the tags of a document.
+
+    Each tag gets its position in document order, so the tags of any
+    subtree make up one contiguous range of positions. The index is
+    built as the parser creates the tags; changes made to the tree
+    through the Tag API mark it as stale and it's rebuilt on the next
+    query. Changes made directly to tag.name or tag.attrs can't be
+    detected: call BeautifulSoup.reindex() after making them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.stale = False
+        self.names = {}
+        self.ids = {}
+        self.classes = {}
+
+    def _add_key(self, table, key, tag):
+        if isinstance(key, bytes):
+            key = key.decode("utf8")
+        positions, tags = table.setdefault(key, ([], []))
+        positions.append(tag._position)
+        tags.append(tag)
+
+    def add(self, tag):
+        """Index a tag that follows all the tags indexed so far."""
+        tag._position = self.count
+        self.count += 1
+        self._add_key(self.names, tag.name, tag)
+        attrs = tag.attrs
+        if attrs:
+            value = attrs.get('id')
+            if isinstance(value, basestring):
+                self._add_key(self.ids, value, tag)
+            value = attrs.get('class')
+            if isinstance(value, basestring):
+                self._add_key(self.classes, value, tag)
+            elif isinstance(value, list):
+                for klass in set(value):
+                    if isinstance(klass, basestring):
+                        self._add_key(self.classes, klass, tag)
+
+    def rebuild(self, root):
+        """Index the tags beneath root from scratch."""
+        self.__init__()
+        for descendant in root.descendants:
+            if isinstance(descendant, Tag):
+                self.add(descendant)
+
+    def candidates(self, strainer, start=0, end=None):
+        """Find the tags between positions start and end that might
+        match the strainer.
+
+        :return: None if the index can't narrow down the search, or a
+        (tags, exact) 2-tuple. If exact is true, every tag matches;
+        otherwise the tags still have to be checked against the strainer.
+        """
+        buckets = []
+        if isinstance(strainer.name, unicode):
+            buckets.append(self.names.get(strainer.name, ([], [])))
+        value = strainer.attrs.get('id')
+        if isinstance(value, unicode):
+            buckets.append(self.ids.get(value, ([], [])))
+        value = strainer.attrs.get('class')
+        if isinstance(value, unicode) and not whitespace_re.search(value):
+            buckets.append(self.classes.get(value, ([], [])))
+        if not buckets:
+            return None
+        positions, tags = min(buckets, key=lambda bucket: len(bucket[0]))
+        first = bisect.bisect_left(positions, start)
+        if end is None:
+            last = len(positions)
+        else:
+            last = bisect.bisect_left(positions, end)
+        exact = (len(buckets) == 1 and isinstance(strainer.name, unicode)
+                 and not strainer.attrs)
+        return tags[first:last], exact
+
+
 class ResultSet(list):
     """A ResultSet is just a list that keeps track of the SoupStrainer
     that created it."""
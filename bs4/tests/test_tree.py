@@ -10,6 +10,7 @@ methods tested here.
 """
 
 import copy
+import gc
 import pickle
 import re
 import warnings
@@ -21,7 +22,10 @@ from bs4.builder import (
 from bs4.element import (
     CData,
     Comment,
+    CSSSelector,
     Doctype,
+    EMPTY_ATTRIBUTES,
+    EMPTY_CONTENTS,
     NavigableString,
     SoupStrainer,
     Tag,
@@ -1249,6 +1253,47 @@ class TestCDAtaListAttributes(SoupTest):
             string.name = 'foo'
         self.assertRaises(AttributeError, t)
 
+class TestCompiledStrainer(SoupTest):
+    "SoupStrainer compiles its criteria on the first search."
+
+    def test_compiled_on_first_search(self):
+        strainer = SoupStrainer("table", {"class": "archive_table"})
+        self.assertEqual(None, strainer._match_attrs)
+        soup = self.soup('<table class="archive_table"></table><table></table>')
+        self.assertEqual(soup.table, strainer.search(soup.table))
+        self.assertEqual(1, len(strainer._match_attrs))
+        self.assertEqual(None, strainer.search(soup.find_all('table')[1]))
+
+    def test_search_tag_with_name_and_attrs(self):
+        # This is how the parser consults parse_only.
+        strainer = SoupStrainer("td", class_="x y")
+        self.assertEqual("td", strainer.search_tag("td", {"class": ["x", "y"]}))
+        self.assertEqual(None, strainer.search_tag("td", {"class": ["y", "x"]}))
+        self.assertEqual("td", strainer.search_tag("td", [("class", "x y")]))
+        self.assertEqual(None, strainer.search_tag("th", {"class": "x y"}))
+
+    def test_matchers_agree_with_matches(self):
+        soup = self.soup('<p class="a b" id="x">text</p>')
+        strainer = SoupStrainer()
+        criteria = [True, False, None, u"", u"a", u"a b", u"p",
+                    re.compile("a"), [u"a", u"p"], [], lambda value: value == u"b"]
+        markups = [None, u"a", u"", [u"a", u"b"], [], (u"a",), soup.p, b"a", [None]]
+        for match_against in criteria:
+            match = strainer._compile(match_against)
+            for markup in markups:
+                self.assertEqual(
+                    bool(strainer._matches(markup, match_against)), bool(match(markup)),
+                    "%r against %r" % (markup, match_against))
+
+    def test_pickle_and_copy(self):
+        strainer = SoupStrainer("b", id=["xy", "z"])
+        soup = self.soup('<b id="xy">1</b><b id="yx">2</b>')
+        self.assertEqual(1, len(soup.find_all(strainer)))
+        for clone in (pickle.loads(pickle.dumps(strainer, 2)),
+                      copy.deepcopy(strainer)):
+            self.assertEqual(["1"], [b.string for b in soup.find_all(clone)])
+
+
 class TestPersistence(SoupTest):
     "Testing features like pickle and deepcopy."
 
@@ -1293,6 +1338,176 @@ class TestPersistence(SoupTest):
         loaded = pickle.loads(dumped)
         self.assertEqual(loaded.decode(), soup.decode())
 
+    def test_pickle_protocol_0(self):
+        # Slotted nodes can still be pickled with the oldest protocol.
+        dumped = pickle.dumps(self.tree, 0)
+        loaded = pickle.loads(dumped)
+        self.assertEqual(loaded.decode(), self.tree.decode())
+        self.assertEqual(loaded.a.next_sibling, loaded.find_all('a')[1].previous_sibling)
+
+
+class TestNodeLayout(SoupTest):
+    "Tree nodes keep their state in slots, not in a __dict__."
+
+    def instance_dicts(self, node):
+        attrs = getattr(node, 'attrs', None)
+        return [referent for referent in gc.get_referents(node)
+                if type(referent) is dict and referent is not attrs]
+
+    def test_parsed_nodes_have_no_instance_dict(self):
+        soup = self.soup('<table class="t"><tr><td>1</td><td id="x">2</td></tr></table>')
+        for node in soup.descendants:
+            self.assertEqual([], self.instance_dicts(node))
+
+    def test_arbitrary_attributes_can_still_be_set(self):
+        soup = self.soup("<b>foo</b>")
+        soup.b.note = "tag"
+        soup.b.string.note = "string"
+        self.assertEqual("tag", soup.b.note)
+        self.assertEqual("string", soup.b.string.note)
+        self.assertEqual(1, len(self.instance_dicts(soup.b)))
+
+    def test_navigable_string_subclasses_are_slotted(self):
+        soup = self.soup("<p><!--comment-->text</p>")
+        self.assertEqual([], self.instance_dicts(soup.p.contents[0]))
+        self.assertEqual(Comment, soup.p.contents[0].__class__)
+
+    def test_decompose_clears_slots(self):
+        soup = self.soup("<a><b>foo</b></a><c>bar</c>")
+        b = soup.b
+        string = b.string
+        soup.a.decompose()
+        self.assertEqual("<c>bar</c>", soup.decode())
+        self.assertEqual(None, b.parent)
+        self.assertEqual([], b.contents)
+        self.assertRaises(AttributeError, getattr, string, 'parent')
+
+
+class TestReadOnlyParse(SoupTest):
+    "A read-only parse shares empty attribute dicts and contents lists."
+
+    def test_empty_tags_share_sentinels(self):
+        soup = self.soup('<table><tr><td>1</td><td class="x"></td></tr></table>',
+                         read_only=True)
+        td1, td2 = soup.find_all('td')
+        self.assertTrue(td1.attrs is EMPTY_ATTRIBUTES)
+        self.assertTrue(soup.tr.attrs is EMPTY_ATTRIBUTES)
+        self.assertTrue(td2.contents is EMPTY_CONTENTS)
+        self.assertEqual(["x"], td2['class'])
+        self.assertEqual(["1"], td1.contents)
+
+    def test_default_parse_allocates(self):
+        soup = self.soup("<p></p>")
+        self.assertFalse(soup.p.attrs is EMPTY_ATTRIBUTES)
+        self.assertFalse(soup.p.contents is EMPTY_CONTENTS)
+
+    def test_search_and_output_are_unchanged(self):
+        markup = '<div id="a"><p class="x y">foo<b>bar</b></p><br/><p></p></div>'
+        soup = self.soup(markup)
+        fast = self.soup(markup, read_only=True)
+        self.assertEqual(soup.decode(), fast.decode())
+        self.assertEqual(soup.find_all('p'), fast.find_all('p'))
+        self.assertEqual(soup.find_all(class_='y'), fast.find_all(class_='y'))
+        self.assertEqual(soup.p.get_text(), fast.p.get_text())
+
+    def test_tag_methods_materialize_sentinels(self):
+        soup = self.soup("<p></p><p></p>", read_only=True)
+        first, second = soup.find_all('p')
+        first['id'] = 'one'
+        first.append("text")
+        del second['id']
+        self.assertEqual('<p id="one">text</p><p></p>', soup.decode())
+        self.assertTrue(second.attrs is EMPTY_ATTRIBUTES)
+        self.assertTrue(second.contents is EMPTY_CONTENTS)
+        self.assertEqual({}, EMPTY_ATTRIBUTES)
+        self.assertEqual([], EMPTY_CONTENTS)
+
+    def test_direct_modification_raises(self):
+        soup = self.soup("<p></p>", read_only=True)
+        self.assertRaises(TypeError, soup.p.attrs.__setitem__, 'id', 'x')
+        self.assertRaises(TypeError, soup.p.contents.append, 'x')
+
+    def test_pickle_keeps_sentinels(self):
+        soup = self.soup("<p></p>", read_only=True)
+        loaded = pickle.loads(pickle.dumps(soup, 2))
+        self.assertTrue(loaded.p.attrs is EMPTY_ATTRIBUTES)
+        self.assertTrue(copy.deepcopy(soup).p.contents is EMPTY_CONTENTS)
+
+
+class TestTagIndex(SoupTest):
+    "find_all() answered from the index built with build_index=True."
+
+    markup = ('<div id="main"><table class="archive_table"><tr><td class="x">1</td>'
+              '<td>2</td></tr><tr><td class="x y">3</td><td id="last">4</td></tr>'
+              '</table></div><p class="x">5</p>')
+
+    def setUp(self):
+        super(TestTagIndex, self).setUp()
+        self.plain = self.soup(self.markup)
+        self.indexed = self.soup(self.markup, build_index=True)
+
+    def assertSameResults(self, *args, **kwargs):
+        expected = self.plain.find_all(*args, **kwargs)
+        found = self.indexed.find_all(*args, **kwargs)
+        self.assertEqual([tag.decode() for tag in expected],
+                         [tag.decode() for tag in found])
+
+    def test_index_is_built_during_parse(self):
+        index = self.indexed.tag_index
+        self.assertFalse(index.stale)
+        self.assertEqual(9, index.count)
+        self.assertEqual(None, self.plain.tag_index)
+        self.assertEqual(
+            [0, 1, 2, 3, 4, 5, 6, 7, 8],
+            [tag._position for tag in self.indexed.find_all(True)])
+
+    def test_queries_match_tree_walk(self):
+        self.assertSameResults('td')
+        self.assertSameResults('td', class_='x')
+        self.assertSameResults(class_='x')
+        self.assertSameResults(class_='x y')
+        self.assertSameResults(id='last')
+        self.assertSameResults('p', 'x')
+        self.assertSameResults('td', limit=3)
+        self.assertSameResults(SoupStrainer('td', id='last'))
+        self.assertSameResults('nosuchtag')
+        self.assertEqual(self.plain.find(id='main').name,
+                         self.indexed.find(id='main').name)
+
+    def test_queries_are_restricted_to_subtree(self):
+        first_row, second_row = self.indexed.find_all('tr')
+        self.assertEqual(["1", "2"], [td.string for td in first_row.find_all('td')])
+        self.assertEqual(["3"], [td.string for td in second_row.find_all(class_='x')])
+        self.assertEqual([], first_row.find_all(id='last'))
+        self.assertEqual([], self.indexed.p.find_all(class_='x'))
+
+    def test_candidates(self):
+        index = self.indexed.tag_index
+        tags, exact = index.candidates(SoupStrainer('td'))
+        self.assertEqual(4, len(tags))
+        self.assertTrue(exact)
+        tags, exact = index.candidates(SoupStrainer('td', class_='y'))
+        self.assertEqual(1, len(tags))
+        self.assertFalse(exact)
+        self.assertEqual(None, index.candidates(SoupStrainer(re.compile('t'))))
+
+    def test_modification_marks_index_stale(self):
+        new_td = self.indexed.new_tag('td')
+        new_td['class'] = 'x'
+        self.indexed.tr.append(new_td)
+        self.assertTrue(self.indexed.tag_index.stale)
+        self.assertEqual(3, len(self.indexed.tr.find_all('td')))
+        self.assertFalse(self.indexed.tag_index.stale)
+        self.indexed.p['id'] = 'para'
+        self.assertEqual('p', self.indexed.find(id='para').name)
+        self.indexed.find('td', class_='y').extract()
+        self.assertEqual(3, len(self.indexed.find_all(class_='x')))
+
+    def test_reindex_after_direct_change(self):
+        self.indexed.p.attrs['class'] = ['z']
+        self.indexed.reindex()
+        self.assertEqual('p', self.indexed.find(class_='z').name)
+
 
 class TestSubstitutions(SoupTest):
 
@@ -1827,3 +2042,51 @@ class TestSoupSelector(TreeTest):
 
     def test_sibling_combinator_wont_select_same_tag_twice(self):
         self.assertSelects('p[lang] ~ p', ['lang-en-gb', 'lang-en-us', 'lang-fr'])
+
+    def test_results_in_document_order(self):
+        ids = [el['id'] for el in self.soup.select('div [id]')]
+        expected = [el['id'] for el in self.soup.find('div').find_all(id=True)]
+        self.assertEqual(expected, ids)
+        self.assertEqual(['header2', 'header3'],
+                         [el['id'] for el in self.soup.select('#p1 ~ h2')])
+
+    def test_nth_of_type_counts_siblings(self):
+        # <p> elements are counted among their own siblings, not among
+        # all the candidates found so far.
+        self.assertSelects('div p:nth-of-type(2)', ['p1', 'lang-en-gb'])
+        self.assertSelects('div p:nth-of-type(4)', ['lang-fr'])
+        self.assertSelects('#p1 ~ p:nth-of-type(3)', ['pmulti'])
+
+    def test_leading_child_combinator(self):
+        main = self.soup.find(id="main")
+        self.assertSelectsIDs(main.select('> div'), ['inner'])
+        self.assertSelectsIDs(main.select('> p'),
+                              ['lang-en', 'lang-en-gb', 'lang-en-us', 'lang-fr'])
+        self.assertSelectsIDs(main.select('> h1'), [])
+        self.assertSelectsIDs(main.select('> div > h1'), ['header1'])
+
+    def test_compiled_selector_is_cached(self):
+        selector = CSSSelector.compile('div#inner > p.onep')
+        self.assertTrue(selector is CSSSelector.compile('div#inner > p.onep'))
+        self.soup.select('div#inner > p.onep')
+        self.assertTrue(selector is CSSSelector.compile('div#inner > p.onep'))
+
+    def test_selector_cache_is_bounded(self):
+        old_size = CSSSelector.cache_size
+        CSSSelector.cache_size = 2
+        try:
+            first = CSSSelector.compile('h1')
+            CSSSelector.compile('h2')
+            # Using 'h1' again makes 'h2' the least recently used.
+            CSSSelector.compile('h1')
+            CSSSelector.compile('p')
+            self.assertEqual(['h1', 'p'], list(CSSSelector._cache))
+            self.assertTrue(first is CSSSelector.compile('h1'))
+        finally:
+            CSSSelector.cache_size = old_size
+
+    def test_invalid_selector_is_not_cached(self):
+        self.assertRaises(ValueError, self.soup.select, 'div >')
+        self.assertRaises(ValueError, self.soup.select, 'div > > p')
+        self.assertFalse('div >' in CSSSelector._cache)
+        self.assertFalse('div > > p' in CSSSelector._cache)
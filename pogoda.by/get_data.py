@@ -1,26 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 import __future__
-import urllib2
+import os
+import sys
 
-def download_data(year, month):
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MeteoData import ZipDownloader
+
+def download_data(year, months):
     """
     http://pogoda.by/zip/2011/34504_2011-01.zip
+    Архивы сохраняются как [YYYY]_[MM].zip, целые архивы повторно не загружаются
     """
-    base_url = "http://pogoda.by/zip/"
-    citi_code = "34504"
-    url = base_url+year+"/"+citi_code+"_"+year+"-"+month+".zip"
-    zip_name = year+"_"+month+".zip"
-    zipfile = urllib2.urlopen(url)
-
-    with open(zip_name, 'w') as f: 
-        f.write(zipfile.read())
+    jobs = [(year, month, "%04d_%02d.zip" % (year, month)) for month in months]
+    return ZipDownloader().download(jobs)
 
        
 if __name__ == "__main__":
-    year = "2011"
-    for month in range(1, 13):
-        if month >= 10:
-            download_data(year, str(month))
-        else:
-            download_data(year, "0"+str(month))
+    download_data(2011, range(1, 13))